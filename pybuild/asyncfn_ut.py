@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+import typecheck as _chk; _chk.check(__file__)
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from yfasync import *
+from builder import *
+from watch import *
+from typing import *
+from pathlib import Path
+
+# Unit tests for yfasync's tasks, pool and cancellation and for how BuildEnv
+# uses them, run as: asyncfn_ut.py [-f] [-v]
+
+# Target whose deps, failure and build time are set by the test, every build
+# is recorded in built
+@build_target('.utnode')
+class UtNode(TargetFile):
+    deps: Dict[str, List[str]] = {}
+    fail: Set[str] = set()
+    # built with a `sleep` of this many seconds
+    sleep: Dict[str, float] = {}
+    priority: Dict[str, float] = {}
+    started: List[str] = []
+    built: List[str] = []
+    lck = threading.Lock()
+
+    @classmethod
+    def reset(cls) -> None:
+        cls.deps = {}
+        cls.fail = set()
+        cls.sleep = {}
+        cls.priority = {}
+        cls.started = []
+        cls.built = []
+
+    def build(self) -> AsyncTask[None]:
+        name = self.virtual_path.name
+        def run() -> None:
+            with self.lck:
+                self.started.append(name)
+            if name in self.fail:
+                raise RuntimeError(name)
+            if name in self.sleep:
+                check_process('sleep', self.sleep[name])
+            self.real_path.write_text(name)
+            with self.lck:
+                self.built.append(name)
+        return SyncTask(run, name=name).as_async
+
+    def estimate_duration(self) -> float:
+        return self.priority.get(self.virtual_path.name, 0.0)
+
+    @cached
+    def get_deps(self) -> AsyncTask[List[Path]]:
+        return AsyncTask([Path(d) for d in self.deps.get(self.virtual_path.name, [])])
+
+# fn appending value to values
+def appender(values: List[Any], value: Any) -> Callable[[], None]:
+    return lambda: values.append(value)
+
+class PoolTest(unittest.TestCase):
+    def test_cancel_drops_queued(self) -> None:
+        ran: List[int] = []
+        release = threading.Event()
+        token = CancelToken()
+        with ThreadPool(1) as pool:
+            blocker = SyncTask(release.wait, pool=pool)
+            with cancel_scope(token):
+                queued = [SyncTask(appender(ran, i), pool=pool) for i in range(10)]
+            token.cancel()
+            release.set()
+            self.assertTrue(blocker.wait(5))
+            for task in queued:
+                self.assertTrue(task.wait(5))
+                with self.assertRaises(Cancelled):
+                    task.value
+        self.assertEqual(ran, [])
+
+    def test_shutdown_runs_queued(self) -> None:
+        ran: List[int] = []
+        with ThreadPool(2) as pool:
+            tasks = [SyncTask(appender(ran, i), pool=pool) for i in range(100)]
+        self.assertTrue(all(t.done for t in tasks))
+        self.assertEqual(sorted(ran), list(range(100)))
+
+    def test_priority_order(self) -> None:
+        ran: List[float] = []
+        release = threading.Event()
+        with ThreadPool(1) as pool:
+            SyncTask(release.wait, pool=pool, priority=100.0)
+            for p in (1.0, 3.0, 2.0, 3.0):
+                SyncTask(appender(ran, p), pool=pool, priority=p)
+            release.set()
+        self.assertEqual(ran, [3.0, 3.0, 2.0, 1.0])
+
+    def test_cancel_terminates_process(self) -> None:
+        token = CancelToken()
+        with cancel_scope(token):
+            task = run_process('sleep', '10')
+        start = time.perf_counter()
+        threading.Timer(0.2, token.cancel).start()
+        with self.assertRaises(Cancelled):
+            task.value
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_shared_task_runs_once(self) -> None:
+        calls: List[int] = []
+        def once() -> int:
+            calls.append(1)
+            return 1
+        shared = SyncTask(once).as_async
+        def user() -> Generator[None, None, int]:
+            return (yield from shared.yfvalue) + 1
+        users: List[AsyncTask[int]] = [AsyncTask(user()), AsyncTask(user())]
+        both: AsyncTask[List[int]] = AsyncTask(AsyncTask.yf_all(users))
+        self.assertEqual(both.value, [2, 2])
+        self.assertEqual(calls, [1])
+
+# generator running gen, counting every time it is stepped in steps[name]
+def counted(name: str, steps: Dict[str, int], gen: Generator[None, None, T]) -> Generator[None, None, T]:
+    while True:
+        steps[name] = steps.get(name, 0) + 1
+        try:
+            next(gen)
+        except StopIteration as stop:
+            return cast(T, stop.value)
+        yield
+
+class LoopTest(unittest.TestCase):
+    def test_shared_task_stepped_per_own_wait(self) -> None:
+        steps: Dict[str, int] = {}
+        release = threading.Event()
+        def shared_run() -> Generator[None, None, int]:
+            yield from SyncTask(release.wait).as_async.yfvalue
+            return 1
+        shared: AsyncTask[int] = AsyncTask(counted('shared', steps, shared_run()))
+        def user() -> Generator[None, None, int]:
+            return (yield from shared.yfvalue)
+        users: List[AsyncTask[int]] = [AsyncTask(user()) for _ in range(10)]
+        root: AsyncTask[List[int]] = AsyncTask(AsyncTask.yf_all(users))
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual(root.value, [1] * 10)
+        # started, then woken once its job is done
+        self.assertEqual(steps['shared'], 2)
+
+    def test_layered_graph_steps(self) -> None:
+        # every node waits on every node of the layer below then runs a job,
+        # so the number of paths through it grows as width ** depth
+        steps: Dict[str, int] = {}
+        width = depth = 5
+        below: List[AsyncTask[None]] = []
+        for layer in range(depth):
+            def node(deps: List[AsyncTask[None]], i: int) -> Generator[None, None, None]:
+                yield from AsyncTask.yf_all(deps)
+                yield from SyncTask(lambda: time.sleep(0.001 * i)).as_async.yfvalue
+            below = [AsyncTask(counted(f"{layer}.{i}", steps, node(below, i))) for i in range(width)]
+        root: AsyncTask[List[None]] = AsyncTask(AsyncTask.yf_all(below))
+        root.value
+        self.assertEqual(len(steps), width * depth)
+        # started, woken once its deps are done then once its job is
+        self.assertLessEqual(max(steps.values()), 3)
+
+    def test_task_queue(self) -> None:
+        steps: Dict[str, int] = {}
+        def added() -> Generator[None, None, None]:
+            yield from ()
+        def drain() -> Generator[None, None, List[int]]:
+            found = TaskQueue([SyncTask(lambda: time.sleep(0.001)).as_async for _ in range(50)])
+            # more added while draining, including one already complete
+            found.add(AsyncTask(None))
+            found.add(AsyncTask(counted('added', steps, added())))
+            batches: List[int] = []
+            while found.remaining:
+                batch = yield from found.yf_next()
+                self.assertTrue(all(t.done for t in batch))
+                batches.append(len(batch))
+            self.assertEqual((yield from found.yf_next()), [])
+            return batches
+        root: AsyncTask[List[int]] = AsyncTask(counted('drain', steps, drain()))
+        batches = root.value
+        self.assertEqual(sum(batches), 52)
+        # started by the loop, not by the queue's waits
+        self.assertEqual(steps['added'], 1)
+        # once per batch plus the start
+        self.assertEqual(steps['drain'], len(batches) + 1)
+
+class BuildEnvTest(unittest.TestCase):
+    def setUp(self) -> None:
+        UtNode.reset()
+        self._tmp = tempfile.TemporaryDirectory()
+        set_jobs(4)
+
+    def tearDown(self) -> None:
+        set_jobs(os.cpu_count() or 1)
+        self._tmp.cleanup()
+
+    def env(self, root: str) -> BuildEnv:
+        env = BuildEnv(root, build_dir=Path(self._tmp.name))
+        env.verbosity = 0
+        return env
+
+    def test_fail_fast(self) -> None:
+        UtNode.deps['root.utnode'] = ['bad.utnode'] + [f"ok{i}.utnode" for i in range(4)]
+        UtNode.fail.add('bad.utnode')
+        UtNode.priority['bad.utnode'] = 10.0
+        for i in range(4):
+            UtNode.sleep[f"ok{i}.utnode"] = 10
+        set_jobs(1)
+        env = self.env('root.utnode')
+        start = time.perf_counter()
+        with self.assertRaises(RuntimeError):
+            env.run()
+        # the one running sleep (if any) is killed, the rest never start
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual([t.stem for t, _ in env.failures], ['bad'])
+        self.assertLessEqual(len(UtNode.started), 2)
+        self.assertEqual(UtNode.built, [])
+
+    def test_keep_going(self) -> None:
+        UtNode.deps['root.utnode'] = ['bad1.utnode', 'ok1.utnode', 'mid.utnode']
+        UtNode.deps['mid.utnode'] = ['bad2.utnode', 'ok2.utnode']
+        UtNode.fail.update(['bad1.utnode', 'bad2.utnode'])
+        env = self.env('root.utnode')
+        env.keep_going = True
+        with self.assertRaises(RuntimeError):
+            env.run()
+        self.assertEqual(sorted(t.stem for t, _ in env.failures), ['bad1', 'bad2'])
+        self.assertEqual(sorted(UtNode.built), ['ok1.utnode', 'ok2.utnode'])
+
+    def test_diamond_builds_once(self) -> None:
+        UtNode.deps['root.utnode'] = ['a.utnode', 'b.utnode']
+        UtNode.deps['a.utnode'] = ['c.utnode']
+        UtNode.deps['b.utnode'] = ['c.utnode']
+        env = self.env('root.utnode')
+        env.run()
+        self.assertEqual(sorted(UtNode.built), ['a.utnode', 'b.utnode', 'c.utnode', 'root.utnode'])
+        self.assertIs(env.build(Path('c.utnode')), env.build(Path('c.utnode')))
+        self.assertEqual(env.counters['targets built'], 4)
+        # and nothing again on a second run
+        env.new_run()
+        env.run()
+        self.assertEqual(len(UtNode.built), 4)
+
+class WatchTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self._tmp.name).resolve()
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+
+    def check_missed_edit(self, watcher: Watcher) -> None:
+        seen_file = self.dir / 'sub' / 'seen.h'
+        other = self.dir / 'sub' / 'other.h'
+        seen_file.parent.mkdir()
+        seen_file.write_text('a\n')
+        other.write_text('a\n')
+        st = seen_file.stat()
+        seen = {seen_file: (st.st_mtime_ns, st.st_size)}
+        # edited after the build looked at it, before it was watched
+        seen_file.write_text('ab\n')
+        try:
+            watcher.watch([seen_file, other], seen)
+            self.assertEqual(watcher.wait(0.1), {seen_file})
+            self.assertEqual(watcher.wait(0.1), set())
+            other.write_text('b\n')
+            self.assertEqual(watcher.wait(1), {other})
+        finally:
+            watcher.close()
+
+    def test_poll_missed_edit(self) -> None:
+        self.check_missed_edit(PollWatcher())
+
+    def test_inotify_missed_edit(self) -> None:
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError):
+            self.skipTest('no inotify')
+        self.check_missed_edit(watcher)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+import typecheck as _chk; _chk.check(__file__)
+
+import argparse
+import base64
+import heapq
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+from builder import *
+from builder import _parse_dep_output
+from yfasync import AsyncTask, SyncTask, TaskQueue, ThreadPool, Tracer, set_tracer
+from jbin import hex_to_jbin
+from typing import *
+from pathlib import Path
+
+# Micro benchmarks for the hot spots in builder/yfasync, run as: bench.py <name> [-n N]
+
+def timed(fn: Callable[[], Any], repeat: int=3) -> float:
+    best: Optional[float] = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert best is not None
+    return best
+
+# _parse_dep_output as it was before the tokenizer rewrite, kept to compare against
+def parse_dep_output_v0(output: str) -> List[Path]:
+    in_sep = False
+    parts = ['']
+    while len(output):
+        if output[0] == '\\':
+            output = output[1:]
+            if in_sep and output[0].isspace():
+                output = output[1:]
+                continue
+            else:
+                in_sep = False
+        elif output[0].isspace():
+            if not in_sep:
+                parts.append('')
+            in_sep = True
+            output = output[1:]
+            continue
+        in_sep = False
+        parts[-1] += output[0]
+        output = output[1:]
+    return [Path(s) for s in parts[1:]]
+
+def bench_deps(n: int) -> None:
+    headers = [f"/usr/include/boost/some/deep/include/tree/header_{i}.hpp" for i in range(n)]
+    output = 'main.o: main.cpp \\\n ' + ' \\\n '.join(headers)
+    print(f"{n} headers, {len(output) // 1024} KiB of make rule")
+    assert parse_dep_output_v0(output) == _parse_dep_output(output)
+    old = timed(lambda: parse_dep_output_v0(output), repeat=1)
+    new = timed(lambda: _parse_dep_output(output))
+    print(f"  char at a time: {old * 1000:.1f} ms")
+    print(f"  tokenizer:      {new * 1000:.1f} ms")
+
+# n c sources each including a chain of project headers and some libc ones
+def write_c_sources(path: Path, n: int) -> List[Path]:
+    for i in range(8):
+        (path / f"h{i}.h").write_text(f"#pragma once\n#include <stdio.h>\n#include \"h{i + 1}.h\"\n" if i < 7 else "#pragma once\n#include <string.h>\n")
+    srcs = [path / f"s{i}.c" for i in range(n)]
+    for i, src in enumerate(srcs):
+        src.write_text(f'#include "h{i % 8}.h"\n#include <stdlib.h>\nint s{i}(void) {{ return {i}; }}\n')
+    return srcs
+
+def bench_deps_scan(n: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        srcs = write_c_sources(Path(tmp_dir), n)
+        assert c_cpp_deps_batch('gcc', [], srcs) == [c_cpp_deps_batch('gcc', [], [s])[0] for s in srcs]
+        print(f"{n} c sources, gcc -MM")
+        separate = timed(lambda: [c_cpp_deps_batch('gcc', [], [s]) for s in srcs])
+        batched = timed(lambda: c_cpp_deps_batch('gcc', [], srcs))
+        print(f"  one run per source: {separate * 1000:7.1f} ms")
+        print(f"  one run for all:    {batched * 1000:7.1f} ms")
+
+# run_jbin_build's converter as it was before the streaming rewrite, kept to compare against
+def hex_to_jbin_v0(hex_path: Path, jbin_path: Path) -> None:
+    with hex_path.open('r') as hex_file, jbin_path.open('w') as jbin_file:
+        # Intel hex decoder
+        # https://en.wikipedia.org/wiki/Intel_HEX
+        decoded: Dict[Union[int, str], Union[int, bytes]] = {}
+        offset = 0
+        for line in hex_file:
+            line = line.strip()
+            if line == '':
+                continue
+            assert line[:1] == ':'
+            assert len(line) >= 11
+            count = int(line[1:3], 16)
+            addr = int(line[3:7], 16)
+            rectype = int(line[7:9], 16)
+            hex_data = line[9:-2]
+            assert len(hex_data) == count * 2, f"count={count:x} addr={addr:x} rectype={rectype:x} line={line}"
+            data = bytes.fromhex(hex_data)
+            assert len(data) == count
+            checksum = int(line[-2:], 16)
+            if rectype == 0x00: # Data
+                decoded[offset + addr] = data
+            elif rectype == 0x01: # End Of File
+                assert count == 0
+                break
+            elif rectype == 0x02: # Extended Segment Address
+                assert count == 0
+                offset = int(hex_data, 16) * 16
+            elif rectype == 0x03: # Start Segment Address
+                assert count == 4
+                decoded['.text-start'] = int(hex_data[:4], 16)
+                decoded['.pc-start'] = int(hex_data[4:])
+            elif rectype == 0x04: # Extended Linear Address
+                assert count == 2
+                offset = (offset & 0xffff) | int(hex_data, 16) << 16
+            elif rectype == 0x05: # Start Linear Address
+                assert count == 4
+                decoded['.pc-start'] = int(hex_data, 16)
+
+        # Sort and merge data
+        data_segs = [k for k in decoded if isinstance(k, int)]
+        data_segs.sort()
+        prev_addr = None
+        data_dict = {}
+        for addr in data_segs:
+            data_chunk = decoded[addr]
+            assert isinstance(data_chunk, bytes)
+            if prev_addr is not None and prev_addr + len(data_dict[prev_addr]) >= addr:
+                data_dict[prev_addr] = data_dict[prev_addr][:addr - prev_addr] + data_chunk
+            else:
+                data_dict[addr] = data_chunk
+                prev_addr = addr
+
+        jbin_file.write('{\n')
+        pc_start = decoded['.pc-start']
+        assert isinstance(pc_start, int)
+        jbin_file.write(f'\t"pc-start": "0x{pc_start:x}",\n')
+        if '.text-start' in decoded:
+            text_start = decoded['.text-start']
+            assert isinstance(text_start, int)
+            jbin_file.write(f'\t"text-start": "0x{text_start:x}",\n')
+        jbin_file.write('\t"data":{\n')
+        first = True
+        for addr in data_dict:
+            if not first:
+                jbin_file.write(',\n')
+            data_chunk = data_dict[addr]
+            assert isinstance(data_chunk, bytes)
+            jbin_file.write(f'\t\t"0x{addr:08x}":"b64:{base64.b64encode(data_chunk).decode()}"')
+            first = False
+        jbin_file.write('\n\t}\n')
+        jbin_file.write('}\n')
+
+def write_hex(path: Path, size: int, *, record_size: int=32, pc_start: int=0x8000_0000, shuffle: bool=False) -> None:
+    rand = random.Random(0)
+    def record(rectype: int, addr: int, data: bytes) -> str:
+        rec = bytes([len(data), addr >> 8, addr & 0xff, rectype]) + data
+        return f":{rec.hex().upper()}{(-sum(rec)) & 0xff:02X}\n"
+    addrs = list(range(pc_start, pc_start + size, record_size))
+    if shuffle:
+        rand.shuffle(addrs)
+    with path.open('w') as f:
+        prev_addr = None
+        for addr in addrs:
+            if prev_addr is None or addr >> 16 != prev_addr >> 16:
+                f.write(record(0x04, 0, (addr >> 16).to_bytes(2, 'big')))
+            f.write(record(0x00, addr & 0xffff, rand.randbytes(record_size)))
+            prev_addr = addr
+        f.write(record(0x05, 0, pc_start.to_bytes(4, 'big')))
+        f.write(record(0x01, 0, b''))
+
+def bench_jbin(n: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        # same output as before, including out of order records
+        for shuffle in (False, True):
+            write_hex(tmp / 'check.hex', 64 << 10, shuffle=shuffle)
+            hex_to_jbin_v0(tmp / 'check.hex', tmp / 'v0.jbin')
+            hex_to_jbin(tmp / 'check.hex', tmp / 'new.jbin')
+            assert (tmp / 'v0.jbin').read_bytes() == (tmp / 'new.jbin').read_bytes()
+
+        hex_path = tmp / 'image.hex'
+        write_hex(hex_path, n << 20)
+        print(f"{n} MiB image, {hex_path.stat().st_size >> 20} MiB of hex")
+        # the old converter is quadratic, past a couple of MiB it takes minutes
+        if n <= 2:
+            old = timed(lambda: hex_to_jbin_v0(hex_path, tmp / 'v0.jbin'), repeat=1)
+            print(f"  dict and concatenate: {old:.2f} s")
+        new = timed(lambda: hex_to_jbin(hex_path, tmp / 'new.jbin'), repeat=1)
+        print(f"  streaming:            {new:.2f} s")
+
+def bench_startup(n: int) -> None:
+    build_py = Path(__file__).resolve().parent / 'build.py'
+    stamps = build_py.parent / '__pycache__' / 'typecheck.json'
+    with tempfile.TemporaryDirectory() as tmp:
+        (Path(tmp) / 'main.c').write_text('int main(void) { return 0; }\n')
+        # returns wall time and the import time -X importtime reports for top level imports
+        def start(typecheck: Optional[str]) -> Tuple[float, float]:
+            env = dict(os.environ)
+            env.pop('PYBUILD_TYPECHECK', None)
+            if typecheck is not None:
+                env['PYBUILD_TYPECHECK'] = typecheck
+            begin = time.perf_counter()
+            proc = subprocess.run([sys.executable, '-X', 'importtime', str(build_py), '--deps', 'main'], cwd=tmp, env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, encoding='utf-8', check=True)
+            wall = time.perf_counter() - begin
+            imports = 0
+            for line in proc.stderr.splitlines():
+                # import time: self [us] | cumulative | imported package, nested imports are indented
+                if line.startswith('import time:') and not line.endswith('imported package'):
+                    _, cumulative, name = line.split('|')
+                    if not name.startswith('  '):
+                        imports += int(cumulative)
+            return wall, imports / 1e6
+        def report(label: str, typecheck: Optional[str], *, cold: bool=False) -> None:
+            results = []
+            for _ in range(n):
+                if cold:
+                    stamps.unlink(missing_ok=True)
+                results.append(start(typecheck))
+            wall = min(w for w, _ in results)
+            imports = min(i for _, i in results)
+            print(f"  {label:28} {wall * 1000:8.1f} ms wall {imports * 1000:8.1f} ms imports")
+        print(f"build.py --deps, best of {n}")
+        report('check every run (before)', '1')
+        report('cold, sources changed', None, cold=True)
+        report('warm, sources unchanged', None)
+        report('PYBUILD_TYPECHECK=0', '0')
+
+# main.cpp and n sources, each including the heavy std headers through common.hpp
+def write_cpp_project(path: Path, n: int) -> None:
+    heavy = ['algorithm', 'iostream', 'map', 'sstream', 'string', 'vector']
+    (path / 'common.hpp').write_text('#pragma once\n' + ''.join(f"#include <{h}>\n" for h in heavy))
+    main = ['#include "common.hpp"\n']
+    main.extend(f'#include "m{i}.hpp"\n' for i in range(n))
+    main.append('int main() { int r = 0;\n')
+    main.extend(f'  r += m{i}();\n' for i in range(n))
+    main.append('  return r == 0 ? 1 : 0; }\n')
+    (path / 'main.cpp').write_text(''.join(main))
+    for i in range(n):
+        (path / f"m{i}.hpp").write_text(f"#pragma once\nint m{i}();\n")
+        (path / f"m{i}.cpp").write_text(''.join([
+            '#include "common.hpp"\n',
+            f'#include "m{i}.hpp"\n',
+            f'int m{i}() {{ std::map<std::string, std::vector<int>> m; std::ostringstream s; s << {i}; m[s.str()].push_back({i}); return (int)m.size(); }}\n',
+        ]))
+
+def run_build(path: Path, *args: str, clean: bool=False) -> None:
+    build_py = Path(__file__).resolve().parent / 'build.py'
+    if clean:
+        subprocess.run([sys.executable, str(build_py), 'main', '--clean'], cwd=path, check=True)
+    subprocess.run([sys.executable, str(build_py), 'main', '--no-cache', *args], cwd=path, check=True, stdout=subprocess.DEVNULL)
+
+def bench_unity(n: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        write_cpp_project(tmp, n)
+        print(f"{n} c++ sources including heavy std headers, full build with {os.cpu_count()} jobs")
+        separate = timed(lambda: run_build(tmp, clean=True), repeat=1)
+        print(f"  separate:      {separate:.2f} s")
+        for size in (8, 16, 32):
+            unity = timed(lambda: run_build(tmp, '--unity', str(size), clean=True), repeat=1)
+            print(f"  --unity {size:<4}   {unity:.2f} s")
+        # an edit to one source rebuilds its bundle only
+        (tmp / 'm0.cpp').touch()
+        edit = timed(lambda: run_build(tmp, '--unity', '32'), repeat=1)
+        print(f"  --unity 32, one source touched: {edit:.2f} s")
+
+def bench_pch(n: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        write_cpp_project(tmp, n)
+        print(f"{n} c++ sources including heavy std headers, full build with {os.cpu_count()} jobs")
+        separate = timed(lambda: run_build(tmp, clean=True), repeat=1)
+        print(f"  no pch:  {separate:.2f} s")
+        pch = timed(lambda: run_build(tmp, '--pch', clean=True), repeat=1)
+        print(f"  --pch:   {pch:.2f} s")
+        # one source touched, the pch stays current
+        (tmp / 'm0.cpp').touch()
+        edit = timed(lambda: run_build(tmp, '--pch'), repeat=1)
+        print(f"  --pch, one source touched: {edit:.2f} s")
+
+# ThreadPool as it was before the deque rewrite (less the job limits), kept to compare against
+class ThreadPoolV0:
+    _cv: threading.Condition
+    _nthreads: int
+    _pending: List[Tuple[float, int, 'SyncTask[Any]']]
+    _queued: int
+    _workers: int
+    _active: int
+
+    def __init__(self, nthreads: int) -> None:
+        self._cv = threading.Condition()
+        self._nthreads = nthreads
+        self._pending = []
+        self._queued = 0
+        self._workers = 0
+        self._active = 0
+
+    def queue(self, task: 'SyncTask[Any]') -> None:
+        with self._cv:
+            heapq.heappush(self._pending, (-task.priority, self._queued, task))
+            self._queued += 1
+            if self._active + len(self._pending) > self._workers and self._workers < self._nthreads:
+                self._workers += 1
+                self._active += 1
+                threading.Thread(target=self._worker, args=[weakref.ref(self)], daemon=True).start()
+            self._cv.notify()
+
+    def __del__(self) -> None:
+        with self._cv:
+            self._workers = 0
+            self._cv.notify_all()
+
+    @classmethod
+    def _worker(cls, pool: 'weakref.ref[ThreadPoolV0]') -> None:
+        _self: Optional['ThreadPoolV0']=pool()
+        while _self is not None and _self._workers > 0:
+            cv = _self._cv
+            with cv:
+                _self._active -= 1
+                while len(_self._pending) == 0:
+                    del _self
+                    cv.wait()
+                    _self = pool()
+                    if _self is None or _self._workers == 0:
+                        return
+                _, _, task = heapq.heappop(_self._pending)
+                _self._active += 1
+                if len(_self._pending) > 0:
+                    _self._cv.notify()
+            task.try_exec()
+
+# queues n tasks that do nothing and waits for them all, all at one
+# priority, at 64 priorities and each at its own
+def bench_pool(n: int) -> None:
+    def noop() -> None:
+        pass
+    schemes: Dict[str, Callable[[int], float]] = {
+        'one priority': lambda i: 0.0,
+        '64 priorities': lambda i: float(i % 64),
+        'all distinct': lambda i: random.random(),
+    }
+    def run(pool: Any, priority: Callable[[int], float]) -> None:
+        tasks = [SyncTask(noop, pool=pool, priority=priority(i)) for i in range(n)]
+        for task in tasks:
+            task.wait()
+    print(f"{n} trivial tasks")
+    for nthreads in (4, 16):
+        for scheme, priority in schemes.items():
+            old = timed(lambda: run(ThreadPoolV0(nthreads), priority), repeat=1)
+            def run_new() -> None:
+                with ThreadPool(nthreads) as pool:
+                    run(pool, priority)
+            new = timed(run_new, repeat=1)
+            print(f"  {nthreads:2} threads, {scheme:<14} old: {old:.2f} s  new: {new:.2f} s  ({old / new:.1f}x)")
+    def run_fifo() -> None:
+        with ThreadPool(4, priorities=False) as pool:
+            run(pool, lambda i: 0.0)
+    print(f"   4 threads, no priorities   new: {timed(run_fifo, repeat=1):.2f} s")
+
+# generator steps and main thread time of the loop running root, from its trace
+def loop_steps(root: 'AsyncTask[Any]') -> Tuple[int, float]:
+    tracer = Tracer()
+    set_tracer(tracer)
+    try:
+        root.value
+    finally:
+        set_tracer(None)
+    with tempfile.TemporaryDirectory() as tmp:
+        trace = Path(tmp) / 'trace.json'
+        tracer.write(str(trace))
+        events = json.loads(trace.read_text())['traceEvents']
+    loops = [e for e in events if e['name'] == 'loop']
+    return sum(e['args']['steps'] for e in loops), sum(e['args']['stepping_ms'] for e in loops) / 1000
+
+# Layered graphs, every node waiting on every node of the layer below it then
+# running a job (as targets do), the steps should follow the nodes and edges
+# rather than the paths through the graph. And the steps taking results in
+# completion order, which should follow the jobs
+def bench_sched(n: int) -> None:
+    def sleep(seconds: float) -> Callable[[], None]:
+        return lambda: time.sleep(seconds)
+    with ThreadPool(8) as pool:
+        def layered(depth: int, width: int) -> 'AsyncTask[Any]':
+            below: List[AsyncTask[None]] = []
+            for _ in range(depth):
+                def node(deps: List[AsyncTask[None]], i: int) -> Generator[None, None, None]:
+                    yield from AsyncTask.yf_all(deps)
+                    yield from SyncTask(sleep(0.001 * (i + 1)), pool=pool).as_async.yfvalue
+                below = [AsyncTask(node(below, i)) for i in range(width)]
+            return AsyncTask(AsyncTask.yf_all(below))
+        for size in (3, 4, 5, n):
+            steps, cpu = loop_steps(layered(size, size))
+            print(f"  {size}x{size} layers, {size * size:4} nodes: {steps:7} steps {cpu * 1000:8.1f} ms stepping")
+        # one task working through jobs as they complete, as ExeFile.get_deps does
+        def drain(count: int) -> Generator[None, None, int]:
+            found = TaskQueue([SyncTask(sleep(0.001), pool=pool).as_async for _ in range(count)])
+            total = 0
+            while found.remaining:
+                total += len((yield from found.yf_next()))
+            return total
+        for count in (100, 200, 400):
+            steps, cpu = loop_steps(AsyncTask(drain(count)))
+            print(f"  draining {count:3} jobs as they complete: {steps:7} steps {cpu * 1000:8.1f} ms stepping")
+
+benchmarks: Dict[str, Tuple[Callable[[int], None], int]] = {
+    'deps': (bench_deps, 5000),
+    'deps-scan': (bench_deps_scan, 32),
+    'jbin': (bench_jbin, 16),
+    'startup': (bench_startup, 5),
+    'unity': (bench_unity, 64),
+    'pch': (bench_pch, 64),
+    'pool': (bench_pool, 100000),
+    'sched': (bench_sched, 16),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=list(benchmarks))
+    parser.add_argument('-n', type=int, default=None, help='Problem size, each benchmark has its own default')
+    args = parser.parse_args()
+
+    fn, default_n = benchmarks[args.benchmark]
+    fn(default_n if args.n is None else args.n)
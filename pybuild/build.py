@@ -1,22 +1,29 @@
 #!/usr/bin/env python3
-import mypycheck as _chk; _chk.check(__file__)
+import typecheck as _chk; _chk.check(__file__)
 
 import argparse
+import glob
+import math
+import os
 import shutil
 import shlex
 import subprocess as sp
 import sys
 import tempfile
+import time
 
 from yfasync import *
 from builder import *
+from watch import *
+from server import *
+from jbin import hex_to_sbin
 from typing import *
 from pathlib import Path
 
-# TODO: -unit-test integration too! build.py --test ut_thing.cpp, and build.py --test thing.cpp should both work if thing.cpp has UT stuff in it, and ut stuff should disapear with peproc stuffs in normal builds
+# TODO: -build.py --test thing.cpp for UT stuff inside thing.cpp itself, ut stuff should disapear with peproc stuffs in normal builds
+#         (--test ut_thing.cpp, and only rerunning tests whose sources changed, are done, see TestRun)
 #       -Need some way of configuring build settings in source c/cpp files
-#       -Incremental Unitests (some way of referencing ut's from soure files and executin on local changes)
-#         -once this is done, ut on obj builds is possible :)
+#       -ut on obj builds, running the tests of the sources an object is built from
 #       -Kernel modules ;) .ko target
 
 # Existing file targets (usually c/c++) files don't need a target file type they are just treated as in-place files
@@ -35,16 +42,18 @@ class CObj(TargetFile):
     parent_target = ''
 
     def build(self) -> AsyncTask[None]:
-        return run_process(self.env.cc, *self.env.cc_flags, '-c', '-o', self.real_path, self.src, verbosity=env.verbosity)
+        return compile_obj(self, self.env.cc, self.env.cc_flags, self.src, 'c')
 
     @property
     def src(self) -> Path:
         return self.virtual_path.parent / f"{self.virtual_path.stem}.c"
 
+    def estimate_duration(self) -> float:
+        return estimate_from_size(self.src)
+
     @cached
     def get_deps(self) -> AsyncTask[List[Path]]:
-        src_path = self.virtual_path.parent / f"{self.stem}.c"
-        return run_c_cpp_deps('gcc', [], src_path, 0)
+        return self.env.c_cpp_deps(self, 'gcc', self.src)
 
 @build_target('.cpp')
 class CppSrc(TargetFile):
@@ -56,37 +65,166 @@ class CppObj(TargetFile):
     parent_target = ''
 
     def build(self) -> AsyncTask[None]:
-        return run_process(self.env.cxx, *self.env.cxx_flags, '-c', '-o', self.real_path, self.src, verbosity=env.verbosity)
+        return compile_obj(self, self.env.cxx, self.env.cxx_flags, self.src, 'c++')
 
     @property
     def src(self) -> Path:
         return self.virtual_path.parent / f"{self.virtual_path.stem}.cpp"
 
+    def estimate_duration(self) -> float:
+        return estimate_from_size(self.src)
+
     @cached
     def get_deps(self) -> AsyncTask[List[Path]]:
-        src_path = self.virtual_path.parent / f"{self.stem}.cpp"
-        return run_c_cpp_deps('g++', [], src_path, 0)
+        return self.env.c_cpp_deps(self, 'g++', self.src)
     
+# Precompiled prefix header, <stem>.h for c or <stem>.hpp for c++. The header
+# is generated next to it in the .obj tree (see select_pch), and it is
+# only rebuilt when that or something it includes changes
+@build_target('.gch')
+class PchFile(TargetFile):
+    @property
+    def header(self) -> Path:
+        return self.real_path.parent / self.stem
+
+    @property
+    def lang(self) -> str:
+        return 'c++' if self.stem.endswith('.hpp') else 'c'
+
+    def build(self) -> AsyncTask[None]:
+        if self.lang == 'c++':
+            return self.env.compile(self, self.env.cxx, [*self.env.cxx_flags, '-x', 'c++-header'], self.header)
+        return self.env.compile(self, self.env.cc, [*self.env.cc_flags, '-x', 'c-header'], self.header)
+
+    @cached
+    def get_deps(self) -> AsyncTask[List[Path]]:
+        return self.env.c_cpp_deps(self, 'g++' if self.lang == 'c++' else 'gcc', self.header)
+
+# compile obj, with the precompiled header for lang if there is one and obj
+# includes every header in it anyway
+def compile_obj(obj: TargetFile, compiler: str, flags: List[Any], src: Path, lang: str) -> AsyncTask[None]:
+    pch = obj.env.pch.get(lang)
+    # with compile_deps the compile is what finds obj's deps, too late to pick
+    if pch is None or obj.env.compile_deps:
+        return obj.env.compile(obj, compiler, flags, src)
+    gch_path, headers = pch
+    def run() -> Generator[None, None, None]:
+        deps = yield from obj.get_deps().yfvalue
+        obj_flags = flags
+        if set(headers) <= set(obj.env.stats.resolve(d) for d in deps):
+            yield from obj.env.build(gch_path, path_cost=current_priority()).yfvalue
+            gch = cast(PchFile, obj.env.get_target(gch_path))
+            obj_flags = [*flags, '-Winvalid-pch', '-include', gch.header]
+            obj.env.count('pch compiles')
+        yield from obj.env.compile(obj, compiler, obj_flags, src).yfvalue
+    return AsyncTask(run())
+
+# Static library of the objects for every c/c++ source in the directory next
+# to it with the same name, eg. lib/foo.a for lib/foo/*.c(pp). Only the
+# objects that changed are replaced when it is updated
+@build_target('.a')
+class ArchiveFile(TargetFile):
+    @property
+    def src_dir(self) -> Path:
+        return self.virtual_path.parent / self.stem
+
+    @property
+    def has_cpp(self) -> bool:
+        return any(d.suffix == '.o++' for d in self.get_deps().value)
+
+    def build(self) -> AsyncTask[None]:
+        def run() -> Generator[None, None, None]:
+            deps = yield from self.get_deps().yfvalue
+            objs = [self.env.get_real_path(d) for d in deps]
+            yield from run_archive_update(self.real_path, objs, verbosity=self.env.verbosity).yfvalue
+        return AsyncTask(run())
+
+    @cached
+    def get_deps(self) -> AsyncTask[List[Path]]:
+        objs: List[Path] = []
+        if self.src_dir.is_dir():
+            for src in sorted(self.src_dir.iterdir()):
+                if src.suffix == '.c':
+                    objs.append(src.with_suffix('.o'))
+                elif src.suffix == '.cpp':
+                    objs.append(src.with_suffix('.o++'))
+        if not len(objs):
+            raise NotImplementedError(f"No sources found for: {self.virtual_path}\n  searched: {self.src_dir}")
+        return AsyncTask(objs)
+
+# BuildEnv.prepare for --pch. Picks the headers for each language's
+# precompiled header, either the configured env.pch_headers or those included
+# by at least pch_threshold of the root executables' objects (in the order
+# they are first included) and writes them to the pch's header
+def select_pch(env: BuildEnv, roots: List[TargetFile]) -> None:
+    resolve = env.stats.resolve
+    # deps are all done by now
+    objs = [env.get_target(d) for r in roots if isinstance(r, ExeFile) for d in r.get_deps().value]
+    for lang, suffix, obj_type in (('c', '.h', CObj), ('c++', '.hpp', CppObj)):
+        lang_objs = [t for t in objs if type(t) is obj_type]
+        if env.pch_headers is not None:
+            headers = [resolve(h) for h in env.pch_headers]
+        else:
+            counts: Dict[Path, int] = {}
+            for obj in lang_objs:
+                src = resolve(obj.src)
+                for d in set(resolve(d) for d in obj.get_deps().value):
+                    if d != src and env.stats.exists(d):
+                        counts[d] = counts.get(d, 0) + 1
+            need = max(2, math.ceil(env.pch_threshold * len(lang_objs)))
+            headers = []
+            for obj in lang_objs:
+                for d in (resolve(d) for d in obj.get_deps().value):
+                    if counts.get(d, 0) >= need and d not in headers:
+                        headers.append(d)
+        if not len(headers) or not len(lang_objs):
+            env.pch.pop(lang, None)
+            continue
+        # one per build dir, shared by every root
+        gch_path = Path(f"{env.build_dir.stem}-pch{suffix}.gch")
+        gch = cast(PchFile, env.get_target(gch_path))
+        lines = [f"// generated by build.py --pch for {env.build_dir}, do not edit\n"]
+        lines.extend(f'#include "{h}"\n' for h in headers)
+        write_if_changed(gch.header, ''.join(lines))
+        env.pch[lang] = (gch_path, headers)
+
+# A unity bundle, one translation unit #including several c++ sources so the
+# headers they share are only parsed once, see ExeFile.unity_deps
+@build_target('.unity')
+class UnityObj(CppObj):
+    @property
+    def src(self) -> Path:
+        return self.env.output_path('unity', self.virtual_path, f"{self.stem}.cpp")
+
 @build_target('')
 class ExeFile(TargetFile):
     @classmethod
     def get_realpath(cls, path: Path, *, env: BuildEnv) -> Path:
-        return env.build_dir / 'bin' / path.stem
+        return env.output_path('bin', path, path.stem)
 
     def build(self) -> AsyncTask[None]:
         def run() -> Generator[None, None, None]:
             deps = yield from self.get_deps().yfvalue
             compiler = self.env.cc
             compiler_flags = self.env.cc_flags
+            objs: List[Path] = []
+            libs: List[Path] = []
             for d in deps:
-                if str(d).endswith('.o++'):
+                target = self.env.get_target(d)
+                if isinstance(target, CppObj) or (isinstance(target, ArchiveFile) and target.has_cpp):
                     compiler = self.env.cxx
                     compiler_flags = self.env.cxx_flags
-            deps = [self.env.get_real_path(d) for d in deps]
+                if isinstance(target, ArchiveFile):
+                    libs.append(target.real_path)
+                else:
+                    objs.append(target.real_path)
             cmd: List[Any]=[compiler]
             cmd.extend(compiler_flags)
             cmd.extend(['-o', self.real_path])
-            cmd.extend(deps)
+            cmd.extend(objs)
+            if len(libs):
+                # libraries can use each other in any order
+                cmd.extend(['-Wl,--start-group', *libs, '-Wl,--end-group'])
             yield from run_process(*cmd, verbosity=self.env.verbosity).yfvalue
         return AsyncTask(run())
 
@@ -95,42 +233,96 @@ class ExeFile(TargetFile):
         def run() -> Generator[None, None, List[Path]]:
             c_src = self.virtual_path.parent / f"{self.stem}.c"
             cpp_src = self.virtual_path.parent / f"{self.stem}.cpp"
-            if (c_src).exists():
+            stats = self.env.stats
+            if stats.exists(c_src):
                 root_dep = self.virtual_path.parent / f"{self.stem}.o"
-            elif (cpp_src).exists():
+            elif stats.exists(cpp_src):
                 root_dep = self.virtual_path.parent / f"{self.stem}.o++"
             else:
                 raise NotImplementedError(f"No deps found for: {self.virtual_path}\n  searched: {c_src}\n  and:      {cpp_src}")
 
-            known_deps: Set[Path] = set([root_dep.resolve()])
-            deps: List[Path] = [root_dep]
-            pending = [self.env.get_target(root_dep).get_deps()]
-            while len(pending) > 0:
-                pdeps = yield from pending[0].yfvalue
-                pending = pending[1:]
-                new_deps = set(pdeps)
-                for d in new_deps:
-                    if d.suffix == '.h':
-                        src = d.parent / f"{d.stem}.c"
-                        obj = d.parent / f"{d.stem}.o"
-                    elif d.suffix == '.hpp':
-                        src = d.parent / f"{d.stem}.cpp"
-                        obj = d.parent / f"{d.stem}.o++"
-                    else:
+            known_deps: Set[Path] = set([stats.resolve(root_dep)])
+            deps: List[Path] = []
+            # scan every newly found object at once rather than one at a time
+            found = TaskQueue([self.obj_deps(root_dep)])
+            # keep scanning past a failure so --keep-going sees every one
+            error: Optional[Exception] = None
+            while found.remaining:
+                for task in (yield from found.yf_next()):
+                    try:
+                        task_deps = task.value
+                    except Exception as err:
+                        error = error or err
                         continue
+                    for d in set(task_deps):
+                        if d.suffix == '.h':
+                            src = d.parent / f"{d.stem}.c"
+                            obj = d.parent / f"{d.stem}.o"
+                        elif d.suffix == '.hpp':
+                            src = d.parent / f"{d.stem}.cpp"
+                            obj = d.parent / f"{d.stem}.o++"
+                        else:
+                            continue
 
-                    if obj.resolve() not in known_deps and src.exists():
-                        known_deps.add(obj.resolve())
-                        deps.append(obj)
-                        pending.append(self.env.get_target(obj).get_deps())
+                        obj_key = stats.resolve(obj)
+                        if obj_key not in known_deps and stats.exists(src):
+                            known_deps.add(obj_key)
+                            deps.append(obj)
+                            found.add(self.obj_deps(obj))
+            if error is not None:
+                raise error
+            # objects are found in completion order, sort to keep the link line stable
+            deps.sort()
+            deps = [root_dep] + deps
+            if len(self.env.lib_dirs):
+                deps = self.lib_deps(deps)
+            if self.env.unity_size is not None:
+                deps = self.unity_deps(deps)
             return deps
         return AsyncTask(run())
 
+    # with compile_deps this compiles obj, so the task gets the priority
+    # obj's own build would have, its duration plus the path from here to the root
+    def obj_deps(self, obj: Path) -> AsyncTask[List[Path]]:
+        target = self.env.get_target(obj)
+        with task_priority(current_priority() + self.env.expected_duration(target)):
+            return target.get_deps()
+
+    # objects from env.lib_dirs replaced by the static library for their directory
+    def lib_deps(self, deps: List[Path]) -> List[Path]:
+        lib_dirs = set(self.env.stats.resolve(d) for d in self.env.lib_dirs)
+        ret: List[Path] = []
+        libs: List[Path] = []
+        for d in deps:
+            src_dir = d.parent
+            if d is deps[0] or self.env.stats.resolve(src_dir) not in lib_dirs:
+                ret.append(d)
+            elif src_dir.parent / f"{src_dir.name}.a" not in libs:
+                libs.append(src_dir.parent / f"{src_dir.name}.a")
+        return ret + libs
+
+    # the c++ objects in deps replaced by unity bundles of their sources
+    def unity_deps(self, deps: List[Path]) -> List[Path]:
+        assert self.env.unity_size is not None
+        cpp_objs = [cast(CppObj, self.env.get_target(d)) for d in deps if d.suffix == '.o++']
+        bundles = self.env.unity.assign(self.real_path, [o.src.resolve() for o in cpp_objs], self.env.unity_size)
+        ret = [d for d in deps if d.suffix != '.o++']
+        for i, srcs in enumerate(bundles):
+            if not len(srcs):
+                continue
+            bundle = self.env.get_target(self.virtual_path.parent / f"{self.stem}-unity{i}.unity")
+            assert isinstance(bundle, UnityObj)
+            lines = [f"// generated by build.py --unity for {self.stem}, do not edit\n"]
+            lines.extend(f'#include "{src}"\n' for src in srcs)
+            write_if_changed(bundle.src, ''.join(lines))
+            ret.append(bundle.virtual_path)
+        return ret
+
 @build_target('.hex')
 class HexDump(TargetFile):
     @classmethod
     def get_realpath(cls, path: Path, *, env: BuildEnv) -> Path:
-        return env.build_dir / 'bin' / f"{path.stem}.hex"
+        return env.output_path('bin', path, f"{path.stem}.hex")
 
     def build(self) -> AsyncTask[None]:
         return run_process('objcopy', '-O', 'ihex', self.env.get_real_path(self.exe), self.real_path, verbosity=self.env.verbosity)
@@ -147,7 +339,7 @@ class HexDump(TargetFile):
 class JBinDump(TargetFile):
     @classmethod
     def get_realpath(cls, path: Path, *, env: BuildEnv) -> Path:
-        return env.build_dir / 'bin' / f"{path.stem}.jbin"
+        return env.output_path('bin', path, f"{path.stem}.jbin")
 
     def build(self) -> AsyncTask[None]:
         return run_jbin_build(self.env.get_real_path(self.hex), self.real_path, self.env.verbosity)
@@ -160,6 +352,68 @@ class JBinDump(TargetFile):
     def get_deps(self) -> AsyncTask[List[Path]]:
         return AsyncTask([self.hex])
 
+@build_target('.sbin')
+class SBinDump(TargetFile):
+    @classmethod
+    def get_realpath(cls, path: Path, *, env: BuildEnv) -> Path:
+        return env.output_path('bin', path, f"{path.stem}.sbin")
+
+    def build(self) -> AsyncTask[None]:
+        return run_jbin_build(self.env.get_real_path(self.hex), self.real_path, self.env.verbosity, convert=hex_to_sbin)
+
+    @property
+    def hex(self) -> Path:
+        return self.virtual_path.parent / f"{self.virtual_path.stem}.hex"
+
+    @cached
+    def get_deps(self) -> AsyncTask[List[Path]]:
+        return AsyncTask([self.hex])
+
+# Runs the executable of the same name as a unit test, it passes if it exits
+# with 0. The output of the last passing run is kept as the target, and a
+# test is only run again once a source file in its dep closure or the
+# compiler settings change, see --test
+@build_target('.test')
+class TestRun(TargetFile):
+    @classmethod
+    def get_realpath(cls, path: Path, *, env: BuildEnv) -> Path:
+        return env.output_path('test', path, path.name)
+
+    def build(self) -> AsyncTask[None]:
+        env = self.env
+        exe = env.get_real_path(self.exe)
+        def run() -> None:
+            closure = env.closure_digest(exe, [env.cc, *env.cc_flags, env.cxx, *env.cxx_flags])
+            last = env.tests.get(self.real_path)
+            if last is not None and last[0] == closure:
+                # relinked, but from the same sources
+                self.real_path.touch()
+                env.tests.record(self.real_path, 'cached', last[1])
+                env.count('tests cached')
+                return
+            cmd = [str(exe)]
+            if env.verbosity > 0:
+                print(*[shlex.quote(c) for c in cmd], file=sys.stderr)
+            start = time.perf_counter()
+            try:
+                out = check_output(cmd, stderr=sp.STDOUT)
+            except sp.CalledProcessError:
+                env.tests.record(self.real_path, 'failed', time.perf_counter() - start)
+                env.count('tests failed')
+                raise
+            env.tests.record(self.real_path, 'passed', time.perf_counter() - start, closure=closure)
+            env.count('tests passed')
+            self.real_path.write_text(out)
+        return SyncTask(run, name=f"test {exe}").as_async
+
+    @property
+    def exe(self) -> Path:
+        return self.virtual_path.parent / self.stem
+
+    @cached
+    def get_deps(self) -> AsyncTask[List[Path]]:
+        return AsyncTask([self.exe])
+
 gdb_cmd = """
 set $_exitcode = -999
 catch throw
@@ -169,59 +423,294 @@ if $_exitcode != -999
 end
 """
 
+# every target named, with globs expanded, as root targets without repeats
+def expand_targets(patterns: List[str]) -> List[Path]:
+    ret: List[Path] = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            paths = sorted(Path(p) for p in glob.glob(pattern))
+            if not len(paths):
+                raise FileNotFoundError(f"No targets match: {pattern}")
+        else:
+            paths = [Path(pattern)]
+        for path in paths:
+            root = BuildEnv.root_of(path)
+            if root not in ret:
+                ret.append(root)
+    return ret
+
+# root targets for args, with --test the test for each named target instead
+def select_targets(args: argparse.Namespace) -> List[Path]:
+    targets = expand_targets(args.targets)
+    if args.test:
+        tests = [t if t.suffix == '.test' else t.parent / f"{t.stem}.test" for t in targets]
+        targets = list(dict.fromkeys(tests))
+    return targets
+
+# <target>.build for one target, all.build for several
+def build_dir_for(args: argparse.Namespace, targets: List[Path], build_suffix: str) -> Path:
+    if args.build_dir is not None:
+        return Path(args.build_dir)
+    if len(targets) == 1:
+        return BuildEnv.build_dir_of(targets[0], build_suffix=build_suffix)
+    return Path(f"all{build_suffix}.build")
+
+def make_env(args: argparse.Namespace, targets: List[Path], build_suffix: str) -> BuildEnv:
+    env = BuildEnv(targets[0], build_suffix=build_suffix, build_dir=build_dir_for(args, targets, build_suffix))
+    env.root_targets = targets
+    env.shared_build_dir = len(targets) > 1 or args.build_dir is not None
+    configure_env(env, args)
+    env.cc_flags.extend(['-Wall', '-Werror'])
+    env.cxx_flags.extend(['-Wall', '-Werror', '-std=c++17'])
+    if args.debug:
+        env.cc_flags.extend(['-g', '-O0'])
+        env.cxx_flags.extend(['-g', '-O0'])
+    else:
+        env.cc_flags.extend(['-O3'])
+        env.cxx_flags.extend(['-O3'])
+    return env
+
+# the settings that can change from one build to the next on a build server,
+# the rest are fixed by the build dir
+def configure_env(env: BuildEnv, args: argparse.Namespace) -> None:
+    env.verbosity = args.verbose
+    # --deps should only report deps, not compile to find them, in unity
+    # mode c++ sources aren't compiled on their own, and the precompiled
+    # header is picked from the deps before anything is compiled
+    env.pch_enabled = args.pch or args.pch_header is not None
+    env.pch_headers = None if args.pch_header is None else [Path(h) for h in args.pch_header]
+    env.prepare = (lambda roots: select_pch(env, roots)) if env.pch_enabled else None
+    env.compile_deps = not args.deps and args.unity is None and not env.pch_enabled
+    env.unity_size = args.unity
+    env.lib_dirs = [Path(d) for d in args.lib or []]
+    env.early_cutoff = args.early_cutoff
+    env.keep_going = args.keep_going
+    if args.no_cache:
+        env.obj_cache = None
+    elif env.obj_cache is None:
+        env.obj_cache = ObjectCache(default_cache_dir())
+
+# -j and the limits on starting jobs, memory is given in GB
+def configure_pool(args: argparse.Namespace) -> None:
+    def gb(n: Optional[float]) -> Optional[int]:
+        return None if n is None else int(n * (1 << 30))
+    set_jobs(args.jobs if args.jobs is not None else os.cpu_count() or 1)
+    set_job_limits(max_memory=gb(args.max_memory), min_available=gb(args.min_free), max_load=args.load_average)
+
+_server_watcher: Optional[Watcher] = None
+# --unity and --lib of the last build, what the executables' deps were found with
+_server_exe_settings: Optional[Tuple[Optional[int], List[Path]]] = None
+
+# one build on the build server, files changed since the last one are
+# invalidated and everything is checked again on the same target graph
+def serve_build(env: BuildEnv, parser: argparse.ArgumentParser, argv: List[str]) -> int:
+    global _server_watcher, _server_exe_settings
+    args = parser.parse_args(argv)
+    env.new_run()
+    if _server_watcher is None:
+        _server_watcher = make_watcher()
+    else:
+        env.invalidate(_server_watcher.wait(0))
+    configure_pool(args)
+    set_tracer(Tracer() if args.trace is not None else None)
+    env.root_targets = select_targets(args)
+    env.root_target = env.root_targets[0]
+    configure_env(env, args)
+    exe_settings = (env.unity_size, env.lib_dirs)
+    if exe_settings != _server_exe_settings:
+        for target in env.targets.values():
+            if isinstance(target, ExeFile):
+                clear_cached(target, 'get_deps')
+        _server_exe_settings = exe_settings
+    try:
+        ok = build_root(env, args)
+        if args.test:
+            report_tests(env)
+        return 0 if ok else 1
+    finally:
+        _server_watcher.watch(env.source_files(), env.source_stats())
+
+def build_root(env: BuildEnv, args: argparse.Namespace) -> bool:
+    try:
+        env.run()
+    except sp.CalledProcessError:
+        # with --keep-going there can be more than one
+        for target, err in env.failures:
+            if isinstance(err, sp.CalledProcessError):
+                print("Build failed: ", *err.cmd)
+                # tests have their output all on stdout
+                print(err.stderr if err.stderr is not None else err.output)
+            else:
+                print(f"Build failed: {target.real_path}: {err!r}")
+        if len(env.failures) > 1:
+            print(f"{len(env.failures)} targets failed")
+        return False
+    finally:
+        env.save()
+        report_cache(env)
+        if env.verbosity > 0:
+            for name, n in env.counters.items():
+                print(f"{name}: {n}", file=sys.stderr)
+        tracer = get_tracer()
+        if tracer is not None:
+            tracer.write(args.trace)
+            env.print_timings()
+    return True
+
+# one line on the object cache whenever it was used this run
+def report_cache(env: BuildEnv) -> None:
+    hits = env.counters.get('object cache hits', 0)
+    misses = env.counters.get('object cache misses', 0)
+    if hits + misses > 0:
+        print(f"object cache: {hits} hits, {misses} misses ({100 * hits // (hits + misses)}% hit rate)", file=sys.stderr)
+
+# each test root with whether it passed, ran from cache or didn't get to run,
+# and how long it took
+def report_tests(env: BuildEnv) -> None:
+    counts: Dict[str, int] = {}
+    total = 0.0
+    for path in env.root_targets:
+        test = env.get_target(path)
+        if not isinstance(test, TestRun):
+            continue
+        status, duration = env.tests.runs.get(test.real_path, ('', 0.0))
+        if status == '':
+            task = env.build_task(path)
+            last = env.tests.get(test.real_path)
+            if task is not None and task.done and task.exception is None and last is not None:
+                # up to date with its executable, not even checked
+                status, duration = 'cached', last[1]
+            else:
+                status = 'not run'
+        counts[status] = counts.get(status, 0) + 1
+        if status != 'cached':
+            total += duration
+        print(f"{status:>8} {duration:8.3f}s {test.exe}", file=sys.stderr)
+    summary = ', '.join(f"{n} {status}" for status, n in sorted(counts.items()))
+    print(f"tests: {summary} ({total:.3f}s run)", file=sys.stderr)
+
+def run_root(env: BuildEnv, args: argparse.Namespace) -> None:
+    # TODO: should probably make run a target type porperty, that will allow vm/gdb/sim etc for any new types
+    targ = env.get_real_path(env.root_target)
+    if args.debug:
+        with tempfile.NamedTemporaryFile() as tmp_file:
+            gdb_cmd_path = Path(tmp_file.name)
+            with gdb_cmd_path.open('w') as gdb_cmd_file:
+                gdb_cmd_file.write(gdb_cmd.format(args=''))
+            cmd = ['gdb', '-return-child-result', '-x', str(gdb_cmd_path), str(targ)]
+            if env.verbosity > 0:
+                print(*[shlex.quote(c) for c in cmd], file=sys.stderr)
+            sp.call(cmd)
+    else:
+        cmd = [str(targ)]
+        if env.verbosity > 0:
+            print(*[shlex.quote(c) for c in cmd], file=sys.stderr)
+        sp.call(cmd)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('target')
+    parser.add_argument('targets', nargs='+', metavar='target', help='Targets to build in one go, sharing objects and the build dir. Globs are expanded')
+    parser.add_argument('--build-dir', metavar='DIR', help='Build in DIR instead of <target>.build, or all.build for several targets')
     parser.add_argument('--clean', action='store_true')
     parser.add_argument('--debug', '-g', action='store_true', help='Enable debug mode and start application in debugger if --run-target is also specified')
     parser.add_argument('--deps', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of jobs to run at once, defaults to the cpu count')
+    parser.add_argument('--max-memory', type=float, metavar='GB', help="Don't start jobs that would take the memory of the jobs running over GB, going by each target's peak last build")
+    parser.add_argument('--min-free', type=float, metavar='GB', help="Don't start jobs while the memory available would drop below GB")
+    parser.add_argument('-l', '--load-average', type=float, metavar='LOAD', help="Don't start jobs while the load average is above LOAD")
+    parser.add_argument('--early-cutoff', action='store_true', help='Skip rebuilding targets whose deps are newer but have the same content as the last build')
+    parser.add_argument('-k', '--keep-going', action='store_true', help='Build everything that can be built and report every failure, rather than stopping at the first')
+    parser.add_argument('--unity', type=int, nargs='?', const=16, default=None, metavar='N', help='Compile c++ sources in bundles of N (default 16) as single translation units, sources must not clash on file local names')
+    parser.add_argument('--pch', action='store_true', help='Precompile the headers included by nearly every c or c++ source of the executable and compile with them')
+    parser.add_argument('--pch-header', action='append', metavar='HEADER', help='Precompile HEADER (repeatable) rather than picking the headers, implies --pch')
+    parser.add_argument('--lib', action='append', metavar='DIR', help='Link the objects for sources in DIR (repeatable) through the static library DIR.a, built and updated on its own')
+    parser.add_argument('--no-cache', action='store_true', help=f"Don't use the object cache in {default_cache_dir()}")
     parser.add_argument('--run', '-r', action='store_true')
+    parser.add_argument('--test', '-t', action='store_true', help='Build and run the test executable for each target in parallel, tests whose sources are unchanged since they last passed are skipped. Stops at the first failure unless -k is given')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace of the build to FILE and print the slowest targets and critical path')
     parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--watch', '-w', action='store_true', help='Rebuild (and rerun with --run) whenever a source file changes')
+    parser.add_argument('--server', action='store_true', help='Start a background build server for this target, later builds are sent to it')
+    parser.add_argument('--stop-server', action='store_true')
+    parser.add_argument('--no-server', action='store_true', help="Build in this process even if a build server is running")
+    parser.add_argument('--idle-timeout', type=float, default=600.0, metavar='SECONDS', help='Stop the build server after this long without a build')
     args = parser.parse_args()
+    targets = select_targets(args)
+    if args.run and (len(targets) > 1 or args.test):
+        parser.error('--run takes a single target and no --test')
+
+    configure_pool(args)
+    if args.trace is not None:
+        set_tracer(Tracer())
 
     build_suffix = ''
     if args.debug:
         build_suffix += '-g'
+    sock_path = socket_path(build_dir_for(args, targets, build_suffix))
 
-    env = BuildEnv(args.target, build_suffix=build_suffix)
-    env.verbosity = args.verbose
-    env.cc_flags.extend(['-Wall', '-Werror'])
-    env.cxx_flags.extend(['-Wall', '-Werror', '-std=c++17'])
-    if args.debug:
-        env.cc_flags.extend(['-g', '-O0'])
-        env.cxx_flags.extend(['-g', '-O0'])
-    else:
-        env.cc_flags.extend(['-O3'])
-        env.cxx_flags.extend(['-O3'])
+    if args.stop_server:
+        exit(0 if stop_server(sock_path) else 1)
+    if args.server:
+        if server_running(sock_path):
+            print('build server already running:', sock_path, file=sys.stderr)
+            exit(0)
+        if not daemonize(sock_path.parent / 'server.log'):
+            # wait for it to be listening so the next build.py uses it
+            for _ in range(500):
+                if server_running(sock_path):
+                    exit(0)
+                time.sleep(0.01)
+            print('build server failed to start, see', sock_path.parent / 'server.log', file=sys.stderr)
+            exit(1)
+        env = make_env(args, targets, build_suffix)
+        BuildServer(sock_path, lambda argv: serve_build(env, parser, argv), idle_timeout=args.idle_timeout).serve()
+        exit(0)
+    if not (args.no_server or args.deps or args.clean or args.watch):
+        status = request_build(sock_path, sys.argv[1:])
+        if status is not None:
+            if status == 0 and args.run:
+                run_root(make_env(args, targets, build_suffix), args)
+            exit(status)
+
+    env = make_env(args, targets, build_suffix)
 
     if args.deps:
-        for v in env.get_target(args.target).get_deps().value:
-            print(v)
-    else:
-        if args.clean:
-            shutil.rmtree(env.build_dir, ignore_errors=True)
-            if not args.run:
-                exit(0)
+        for target in env.root_targets:
+            for v in env.get_target(target).get_deps().value:
+                print(v)
+        env.save()
+        exit(0)
+
+    if args.clean:
+        shutil.rmtree(env.build_dir, ignore_errors=True)
+        if not args.run and not args.watch:
+            exit(0)
+
+    if args.watch:
+        watcher = make_watcher()
         try:
-            env.build(env.root_target).value
-        except sp.CalledProcessError as err:
-            print("Build failed: ", *err.cmd)
-            print(err.stderr)
-            exit(1)
-        if args.run:
-            # TODO: should probably make run a target type porperty, that will allow vm/gdb/sim etc for any new types
-            targ = env.get_real_path(env.root_target)
-            if args.debug:
-                with tempfile.NamedTemporaryFile() as tmp_file:
-                    gdb_cmd_path = Path(tmp_file.name)
-                    with gdb_cmd_path.open('w') as gdb_cmd_file:
-                        gdb_cmd_file.write(gdb_cmd.format(args=''))
-                    cmd = ['gdb', '-return-child-result', '-x', str(gdb_cmd_path), str(targ)]
-                    if env.verbosity > 0:
-                        print(*[shlex.quote(c) for c in cmd], file=sys.stderr)
-                    sp.call(cmd)
-            else:
-                cmd = [str(targ)]
+            while True:
+                ok = build_root(env, args)
+                if args.test:
+                    report_tests(env)
+                if ok and args.run:
+                    run_root(env, args)
+                watcher.watch(env.source_files(), env.source_stats())
+                print('watching for changes...', file=sys.stderr)
+                changed = wait_for_changes(watcher)
                 if env.verbosity > 0:
-                    print(*[shlex.quote(c) for c in cmd], file=sys.stderr)
-                sp.call(cmd)
+                    print('changed:', *[shlex.quote(str(p)) for p in changed], file=sys.stderr)
+                env.reset_stats()
+                env.invalidate(changed)
+        except KeyboardInterrupt:
+            exit(0)
+        finally:
+            watcher.close()
+
+    ok = build_root(env, args)
+    if args.test:
+        report_tests(env)
+    if not ok:
+        exit(1)
+    if args.run:
+        run_root(env, args)
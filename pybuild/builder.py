@@ -1,12 +1,18 @@
-import mypycheck as _chk; _chk.check(__file__)
+import typecheck as _chk; _chk.check(__file__)
 
 import yfasync as _async
-import base64 as _b64
+import jbin as _jbin
+import hashlib as _hl
+import json as _json
 import os as _os
+import re as _re
+import selectors as _sel
+import shutil as _shutil
 import shlex as _sh
 import subprocess as _sp
 import sys as _sys
 import threading as _thr
+import time as _time
 import typing as _t
 
 from pathlib import Path as _Path
@@ -20,6 +26,15 @@ def cached(fn: _t.Callable[[_t.Any], _t.Any]) -> _t.Callable[[_t.Any], _t.Any]:
         return getattr(self, cache_name)
     return wrap
 
+# forget a value remembered by @cached so the next call recomputes it
+def clear_cached(obj: _t.Any, fn_name: str) -> None:
+    cache_name = f"_cache_{fn_name}"
+    if hasattr(obj, cache_name):
+        delattr(obj, cache_name)
+
+def get_cached(obj: _t.Any, fn_name: str) -> _t.Any:
+    return getattr(obj, f"_cache_{fn_name}", None)
+
 class TargetFile:
     # alows for simpler .c/.cpp definitions without having to rewrite get_realpath for that class
     is_build_target_type: _t.Optional[bool]=None
@@ -37,13 +52,13 @@ class TargetFile:
     @classmethod
     def get_realpath(cls, path: _Path, *, env: 'BuildEnv') -> _Path:
         if cls.is_build_target():
-            return env.build_dir / '.obj' / str(path.resolve())[1:]
+            return env.build_dir / '.obj' / str(env.stats.resolve(path))[1:]
         else:
             return path
 
     def __init__(self, path: _Path, *, env: 'BuildEnv') -> None:
         self.env = env
-        self.key_path = path.resolve()
+        self.key_path = env.stats.resolve(path)
         self.virtual_path = path
         self.real_path = self.get_realpath(path, env=env)
 
@@ -57,6 +72,10 @@ class TargetFile:
     def build(self) -> _async.AsyncTask[None]:
         return _async.AsyncTask(None)
 
+    # guess at build time in seconds, used for scheduling until a real build has been timed
+    def estimate_duration(self) -> float:
+        return 0.0
+
 target_types: _t.Dict[str, _t.Type[TargetFile]]={}
 
 U = _t.TypeVar('U')
@@ -69,45 +88,527 @@ def it_max(values: _t.Iterable[U]) -> _t.Optional[U]:
             ret = max(v, ret) # type: ignore
     return ret
 
+# first build estimate for compiling src, bigger sources take longer
+def estimate_from_size(src: _Path) -> float:
+    try:
+        return src.stat().st_size * 1e-5
+    except OSError:
+        return 0.0
+
+def stat_key(path: str) -> _t.Optional[_t.List[int]]:
+    try:
+        st = _os.stat(path)
+    except FileNotFoundError:
+        # -MG lists missing (generated) headers, valid for as long as they stay missing
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+class StatCache:
+    """os.stat results and resolved paths kept for a run, so each file is
+    looked at once however many targets depend on it. A file's entry is
+    dropped when a target writes it, and between runs only the entries that
+    may have changed are (see forget), resolved paths are kept."""
+    _lck: _thr.Lock
+    _count: _t.Callable[[str, int], None]
+    _stats: _t.Dict[str, _t.Optional[_os.stat_result]]
+    _resolved: _t.Dict[_Path, _Path]
+
+    def __init__(self, count: _t.Callable[[str, int], None]) -> None:
+        self._lck = _thr.Lock()
+        self._count = count
+        self._stats = {}
+        self._resolved = {}
+
+    # None if path doesn't exist
+    def stat(self, path: _t.Union[_Path, str]) -> _t.Optional[_os.stat_result]:
+        key = str(path)
+        with self._lck:
+            if key in self._stats:
+                st = self._stats[key]
+                hit = True
+            else:
+                hit = False
+        if hit:
+            self._count('syscalls avoided', 1)
+            return st
+        try:
+            st = _os.stat(key)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        with self._lck:
+            self._stats[key] = st
+        return st
+
+    def exists(self, path: _t.Union[_Path, str]) -> bool:
+        return self.stat(path) is not None
+
+    # the stat already kept for path without looking again, KeyError if there isn't one
+    def cached(self, path: _t.Union[_Path, str]) -> _t.Optional[_os.stat_result]:
+        with self._lck:
+            return self._stats[str(path)]
+
+    # same as the module level stat_key
+    def stat_key(self, path: _t.Union[_Path, str]) -> _t.Optional[_t.List[int]]:
+        st = self.stat(path)
+        return None if st is None else [st.st_mtime_ns, st.st_size]
+
+    def resolve(self, path: _Path) -> _Path:
+        return self._resolve(path, count=True)
+
+    def _resolve(self, path: _Path, *, count: bool) -> _Path:
+        with self._lck:
+            ret = self._resolved.get(path)
+        if ret is not None:
+            if count:
+                # realpath lstats every component
+                self._count('syscalls avoided', len(ret.parts))
+            return ret
+        ret = path.resolve()
+        with self._lck:
+            self._resolved[path] = ret
+        return ret
+
+    def invalidate(self, path: _Path) -> None:
+        with self._lck:
+            self._stats.pop(str(path), None)
+
+    # Before another run, drops the stats of the changed paths, of anything
+    # under build_dir (written by the build, or removed with it) and of
+    # files that didn't exist, they may have been made since
+    def forget(self, changed: _t.Iterable[_Path], build_dir: _Path) -> None:
+        changed_keys = set(self._resolve(p, count=False) for p in changed)
+        build_key = self._resolve(build_dir, count=False)
+        with self._lck:
+            entries = list(self._stats.items())
+        drop = []
+        for key, st in entries:
+            if st is None:
+                drop.append(key)
+                continue
+            path = self._resolve(_Path(key), count=False)
+            if path in changed_keys or build_key in path.parents:
+                drop.append(key)
+        with self._lck:
+            for key in drop:
+                self._stats.pop(key, None)
+
+class JsonStore:
+    """Dict persisted as json between runs, loaded on first use and only
+    written back if something changed."""
+    _lck: _thr.Lock
+    path: _Path
+    _entries: _t.Optional[_t.Dict[str, _t.Any]]=None
+    _dirty: bool=False
+
+    def __init__(self, path: _Path) -> None:
+        self._lck = _thr.Lock()
+        self.path = path
+
+    # must hold _lck
+    def _load(self) -> _t.Dict[str, _t.Any]:
+        if self._entries is None:
+            try:
+                with self.path.open('r') as f:
+                    self._entries = _json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        assert self._entries is not None
+        return self._entries
+
+    def save(self) -> None:
+        with self._lck:
+            if not self._dirty or self._entries is None:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            with tmp.open('w') as f:
+                _json.dump(self._entries, f)
+            tmp.replace(self.path)
+            self._dirty = False
+
+class DepCache(JsonStore):
+    """Header deps from earlier scans, stored in the build dir. An entry is
+    reused for as long as the source and every file it listed keep the same
+    mtime and size."""
+    stats: StatCache
+
+    def __init__(self, path: _Path, *, stats: StatCache) -> None:
+        super().__init__(path)
+        self.stats = stats
+
+    def get(self, key: str) -> _t.Optional[_t.List[_Path]]:
+        with self._lck:
+            entry = self._load().get(key)
+        if entry is None:
+            return None
+        for dep, st in entry['stats'].items():
+            if self.stats.stat_key(dep) != st:
+                return None
+        return [_Path(d) for d in entry['deps']]
+
+    def put(self, key: str, src: _Path, deps: _t.List[_Path]) -> None:
+        files = [str(src)] + [str(d) for d in deps]
+        # -MG lists a missing header as it was written, relative to the
+        # source's directory (where an #include "..." looks first) is where
+        # making it will change the scan
+        files += [str(src.parent / d) for d in deps if not d.is_absolute() and self.stats.stat_key(d) is None]
+        entry = {
+            'deps': [str(d) for d in deps],
+            'stats': {f: self.stats.stat_key(f) for f in files},
+        }
+        with self._lck:
+            self._load()[key] = entry
+            self._dirty = True
+
+class DigestCache(JsonStore):
+    """Content digests of files, rehashed only when their mtime or size
+    changes, and the input digests each target was last built from."""
+    stats: StatCache
+
+    def __init__(self, path: _Path, *, stats: StatCache) -> None:
+        super().__init__(path)
+        self.stats = stats
+
+    def digest(self, path: _Path) -> str:
+        key = str(path)
+        st = self.stats.stat_key(key)
+        with self._lck:
+            entry = self._load().setdefault('files', {}).get(key)
+        if entry is not None and entry[:2] == st:
+            return _t.cast(str, entry[2])
+        h = _hl.sha256()
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+        with self._lck:
+            self._load()['files'][key] = [*(st or []), h.hexdigest()]
+            self._dirty = True
+        return h.hexdigest()
+
+    def inputs(self, paths: _t.Iterable[_Path]) -> _t.Dict[str, str]:
+        return {str(p): self.digest(p) for p in paths}
+
+    def get_inputs(self, target: _Path) -> _t.Optional[_t.Dict[str, str]]:
+        with self._lck:
+            return _t.cast(_t.Optional[_t.Dict[str, str]], self._load().setdefault('inputs', {}).get(str(target)))
+
+    def set_inputs(self, target: _Path, inputs: _t.Dict[str, str]) -> None:
+        with self._lck:
+            self._load().setdefault('inputs', {})[str(target)] = inputs
+            self._dirty = True
+
+    # target was rebuilt from inputs that weren't recorded
+    def drop_inputs(self, target: _Path) -> None:
+        with self._lck:
+            if self._load().setdefault('inputs', {}).pop(str(target), None) is not None:
+                self._dirty = True
+
+class DurationStore(JsonStore):
+    """How long each target took to build last time, in seconds."""
+
+    def get(self, path: _Path) -> _t.Optional[float]:
+        with self._lck:
+            return _t.cast(_t.Optional[float], self._load().get(str(path)))
+
+    def put(self, path: _Path, duration: float) -> None:
+        with self._lck:
+            self._load()[str(path)] = duration
+            self._dirty = True
+
+class PeakRssStore(DurationStore):
+    """The peak RSS of each target's biggest job last time, in bytes."""
+
+class UnityBundles(JsonStore):
+    """Which unity bundle each source is compiled in, per executable. Kept
+    between runs so adding or removing a source only changes the one bundle
+    it goes in or came out of, the rest keep their sources and objects."""
+
+    # sources split into bundles of at most size, by bundle number. Emptied
+    # bundles keep their number so the ones after them aren't renamed
+    def assign(self, exe: _Path, srcs: _t.Iterable[_Path], size: int) -> _t.List[_t.List[_Path]]:
+        want = set(str(s) for s in srcs)
+        with self._lck:
+            prev: _t.List[_t.List[str]] = self._load().get(str(exe), [])
+            bundles = [[s for s in b if s in want][:size] for b in prev]
+            placed = set(s for b in bundles for s in b)
+            for src in sorted(want - placed):
+                bundle = next((b for b in bundles if len(b) < size), None)
+                if bundle is None:
+                    bundle = []
+                    bundles.append(bundle)
+                bundle.append(src)
+            if bundles != prev:
+                self._load()[str(exe)] = bundles
+                self._dirty = True
+        return [[_Path(s) for s in b] for b in bundles]
+
+class TestResults(JsonStore):
+    """The dep closure digest and duration of each test's last passing run,
+    a test is only run again once its closure changes. runs is how each test
+    went this run: 'passed', 'failed' or 'cached' and the time it took (or
+    took last time for a cached one)."""
+    runs: _t.Dict[_Path, _t.Tuple[str, float]]
+
+    def __init__(self, path: _Path) -> None:
+        super().__init__(path)
+        self.runs = {}
+
+    # (closure digest, duration) of the last pass
+    def get(self, test: _Path) -> _t.Optional[_t.Tuple[str, float]]:
+        with self._lck:
+            entry = self._load().get(str(test))
+        return None if entry is None else (entry[0], entry[1])
+
+    def record(self, test: _Path, status: str, duration: float, *, closure: _t.Optional[str]=None) -> None:
+        with self._lck:
+            self.runs[test] = (status, duration)
+            if status == 'passed':
+                self._load()[str(test)] = [closure, duration]
+                self._dirty = True
+            elif status == 'failed' and self._load().pop(str(test), None) is not None:
+                self._dirty = True
+
+# only touches path if text is new, so anything built from it stays current
+def write_if_changed(path: _Path, text: str) -> bool:
+    try:
+        if path.read_text() == text:
+            return False
+    except OSError:
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(text)
+    tmp.replace(path)
+    return True
+
+def default_cache_dir() -> _Path:
+    return _Path(_os.environ.get('XDG_CACHE_HOME', _Path.home() / '.cache')) / 'pybuild'
+
+class ObjectCache:
+    """ccache style store of compiled objects shared between build dirs.
+    Entries are keyed on the compiler, its flags and the source, and only hit
+    while every header the object was built from has the same content. The
+    least recently used entries are dropped once over max_size bytes. The
+    size of the cache is kept in its size file so that is only checked by
+    walking every entry once it looks to be over."""
+    _lck: _thr.Lock
+    path: _Path
+    max_size: int
+    _compiler_ids: _t.Dict[str, str]
+    # bytes stored since the last trim
+    _stored: int
+
+    def __init__(self, path: _Path, *, max_size: int=5 << 30) -> None:
+        self._lck = _thr.Lock()
+        self.path = path
+        self.max_size = max_size
+        self._compiler_ids = {}
+        self._stored = 0
+
+    def _compiler_id(self, compiler: str) -> str:
+        with self._lck:
+            if compiler not in self._compiler_ids:
+                exe = _shutil.which(compiler) or compiler
+                version = _sp.check_output([exe, '--version'], encoding='utf-8')
+                self._compiler_ids[compiler] = f"{_os.path.realpath(exe)} {stat_key(exe)} {version}"
+            return self._compiler_ids[compiler]
+
+    def key(self, compiler: str, flags: _t.Sequence[_t.Any], src: _Path, digests: DigestCache) -> str:
+        material = [self._compiler_id(compiler), [str(f) for f in flags], _os.getcwd(), str(src), digests.digest(src)]
+        return _hl.sha256(_json.dumps(material).encode()).hexdigest()
+
+    def _entry(self, key: str) -> _t.Tuple[_Path, _Path]:
+        base = self.path / key[:2] / key
+        return base.with_suffix('.json'), base.with_suffix('.obj')
+
+    # copies a cached object into place at obj, returns false on a miss
+    def fetch(self, key: str, obj: _Path, dep_file: _Path, digests: DigestCache) -> bool:
+        manifest, cached_obj = self._entry(key)
+        try:
+            with manifest.open('r') as f:
+                deps: _t.Dict[str, str] = _json.load(f)['deps']
+            for dep, digest in deps.items():
+                if digests.digest(_Path(dep)) != digest:
+                    return False
+            _shutil.copyfile(cached_obj, obj)
+            _os.utime(manifest)
+            _os.utime(cached_obj)
+        except (OSError, ValueError, KeyError):
+            return False
+        with dep_file.open('w') as f:
+            f.write(' '.join([f"{obj}:", *(d.replace(' ', '\\ ') for d in deps)]) + '\n')
+        return True
+
+    def store(self, key: str, obj: _Path, deps: _t.List[_Path], digests: DigestCache) -> None:
+        manifest, cached_obj = self._entry(key)
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename so concurrent builds never see partial entries
+        tmp_obj = cached_obj.with_suffix(f".{_thr.get_ident()}.tmp")
+        _shutil.copyfile(obj, tmp_obj)
+        size = tmp_obj.stat().st_size
+        tmp_obj.replace(cached_obj)
+        tmp_manifest = manifest.with_suffix(f".{_thr.get_ident()}.tmp")
+        with tmp_manifest.open('w') as f:
+            _json.dump({'deps': digests.inputs(deps)}, f)
+        size += tmp_manifest.stat().st_size
+        tmp_manifest.replace(manifest)
+        with self._lck:
+            self._stored += size
+
+    # Drops least recently used entries until under max_size, returns bytes
+    # freed. Nothing to do unless something was stored, and the entries are
+    # only walked once the size file says the cache is over max_size (or
+    # there isn't one yet)
+    def trim(self) -> int:
+        with self._lck:
+            stored = self._stored
+            self._stored = 0
+        if stored == 0:
+            return 0
+        size_path = self.path / 'size'
+        try:
+            # other builds add to it too, a replaced entry is counted twice,
+            # so only an upper bound until the next walk
+            total = int(size_path.read_text()) + stored
+        except (OSError, ValueError):
+            total = None
+        freed = 0
+        if total is None or total > self.max_size:
+            files = [(p.stat(), p) for p in self.path.glob('*/*') if p.is_file()]
+            total = sum(st.st_size for st, _ in files)
+            files.sort(key=lambda f: f[0].st_mtime)
+            for st, p in files:
+                if total - freed <= self.max_size:
+                    break
+                p.unlink(missing_ok=True)
+                freed += st.st_size
+        tmp = size_path.with_suffix(f".{_os.getpid()}.tmp")
+        tmp.write_text(str(total - freed))
+        tmp.replace(size_path)
+        return freed
+
 class BuildEnv:
     _lck: _thr.Lock
     build_dir: _Path
+    # build_dir holds the outputs of several roots (see output_path)
+    shared_build_dir: bool
     cc: str
     cc_flags: _t.List[_t.Any]
     cxx: str
     cxx_flags: _t.List[_t.Any]
+    compile_deps: bool
+    dep_cache: DepCache
+    digests: DigestCache
+    durations: DurationStore
+    peak_rss: PeakRssStore
+    early_cutoff: bool
+    # build everything that can be built rather than stopping at the first failure
+    keep_going: bool
+    # targets that failed to build this run, with why
+    failures: _t.List[_t.Tuple[TargetFile, Exception]]
+    _cancel: _async.CancelToken
+    obj_cache: _t.Optional[ObjectCache]
+    # precompiled headers, either the configured pch_headers or those included
+    # by at least pch_threshold of the objects. pch is the header for each
+    # language ('c', 'c++') picked this run and the headers in it
+    pch_enabled: bool
+    pch_headers: _t.Optional[_t.List[_Path]]
+    pch_threshold: float
+    pch: _t.Dict[str, _t.Tuple[_Path, _t.List[_Path]]]
+    # directories linked through a static library of their objects (see ArchiveFile)
+    lib_dirs: _t.List[_Path]
+    # C++ sources per unity bundle, None to compile each one on its own
+    unity_size: _t.Optional[int]
+    unity: UnityBundles
+    tests: TestResults
+    # the first of root_targets, everything in root_targets is built by run()
     root_target: _Path
+    root_targets: _t.List[_Path]
+    # called with the root targets once their deps are known, before any of them are built
+    prepare: _t.Optional[_t.Callable[[_t.List[TargetFile]], None]]
+    stats: StatCache
     verbosity: int
     targets: _t.Dict[_Path, TargetFile]
+    counters: _t.Dict[str, int]
+    # (start, end) perf_counter times of targets built this run, and the real paths of every checked target's deps
+    build_times: _t.Dict[_Path, _t.Tuple[float, float]]
+    target_deps: _t.Dict[_Path, _t.List[_Path]]
+    _build_tasks: _t.Dict[_Path, _async.AsyncTask[_os.stat_result]]
 
-    def __init__(self, root_target: _t.Union[_Path, str], *, build_suffix: str='') -> None:
+    def __init__(self, root_target: _t.Union[_Path, str], *, build_suffix: str='', build_dir: _t.Optional[_Path]=None) -> None:
         root_target = _Path(root_target)
         self._lck = _thr.Lock()
         self.cc = 'gcc'
         self.cc_flags = []
         self.cxx = 'g++'
         self.cxx_flags = []
+        self.compile_deps = True
+        self.early_cutoff = False
+        self.keep_going = False
+        self.failures = []
+        self._cancel = _async.CancelToken()
+        self.obj_cache = None
+        self.unity_size = None
+        self.lib_dirs = []
+        self.pch_enabled = False
+        self.pch_headers = None
+        self.pch_threshold = 0.9
+        self.pch = {}
         self.verbosity = 1
         self.targets = {}
+        self.counters = {}
+        self.build_times = {}
+        self.target_deps = {}
+        self._build_tasks = {}
+        self.stats = StatCache(self.count)
+        self.root_target = self.root_of(root_target)
+        self.root_targets = [self.root_target]
+        self.prepare = None
+        self.build_dir = self.build_dir_of(root_target, build_suffix=build_suffix) if build_dir is None else build_dir
+        self.shared_build_dir = False
+        self.dep_cache = DepCache(self.build_dir / 'deps.json', stats=self.stats)
+        self.digests = DigestCache(self.build_dir / 'digests.json', stats=self.stats)
+        self.durations = DurationStore(self.build_dir / 'durations.json')
+        self.peak_rss = PeakRssStore(self.build_dir / 'rss.json')
+        self.unity = UnityBundles(self.build_dir / 'unity.json')
+        self.tests = TestResults(self.build_dir / 'tests.json')
+
+    # the target built for root_target, eg. the object file for a source file
+    @staticmethod
+    def root_of(root_target: _t.Union[_Path, str]) -> _Path:
+        root_target = _Path(root_target)
         if root_target.suffix not in target_types:
             raise NotImplementedError(f"Target type '{root_target.suffix}' unknown: {root_target}")
         while target_types[root_target.suffix].parent_target is not None:
             root_target = root_target.parent / f"{root_target.stem}{target_types[root_target.suffix].parent_target}"
-        self.build_dir = _Path(f"{root_target.stem}{build_suffix}.build")
-        self.root_target = root_target
+        return root_target
+
+    @classmethod
+    def build_dir_of(cls, root_target: _t.Union[_Path, str], *, build_suffix: str='') -> _Path:
+        return _Path(f"{cls.root_of(root_target).stem}{build_suffix}.build")
 
     def get_target(self, path: _t.Union[_Path, str]) -> TargetFile:
         path = _Path(path)
-        if path.resolve() in self.targets:
-            return self.targets[path.resolve()]
+        key = self.stats.resolve(path)
+        target = self.targets.get(key)
+        if target is not None:
+            return target
         elif path.suffix in target_types:
-            self.targets[path.resolve()] = target_types[path.suffix](path, env=self)
-            return self.targets[path.resolve()]
-        elif path.exists():
-            self.targets[path.resolve()] = TargetFile(path, env=self)
-            return self.targets[path.resolve()]
+            target = target_types[path.suffix](path, env=self)
+        elif self.stats.exists(path):
+            target = TargetFile(path, env=self)
         else:
             raise NotImplementedError(f"Unknown type: {path.suffix}, for: {path}")
+        self.targets[key] = target
+        return target
+
+    # build_dir/subdir/name for an output of the target at path. In a shared
+    # build dir it goes under path's resolved directory, as objects do under
+    # .obj, so same named targets from different directories don't clash
+    def output_path(self, subdir: str, path: _Path, name: str) -> _Path:
+        if not self.shared_build_dir:
+            return self.build_dir / subdir / name
+        return self.build_dir / subdir / str(self.stats.resolve(path.parent))[1:] / name
 
     def get_real_path(self, path: _Path) -> _Path:
         return self.get_target(path).real_path
@@ -115,36 +616,324 @@ class BuildEnv:
     def get_root_target(self) -> TargetFile:
         return self.get_target(self.root_target)
 
-    def build(self, target_path: _Path, *, _built: _t.Optional[_t.Set[_Path]]=None) -> _async.AsyncTask[_os.stat_result]:
-        def run() -> _t.Generator[None, None, _os.stat_result]:
-            priv_built: _t.Set[_Path]
-            if _built is None:
-                priv_built = set()
+    # c/c++ header deps for obj, only recomputed when the cached deps are out of date.
+    # When compile_deps is set the object is compiled to get them (see dep_file_path),
+    # it is out of date anyway so this saves a separate preprocessor pass
+    def c_cpp_deps(self, obj: TargetFile, compiler: str, src: _Path) -> _async.AsyncTask[_t.List[_Path]]:
+        # seen even if the deps can't be found, so --watch notices it being fixed
+        self.get_target(src)
+        key = ' '.join([compiler, str(self.stats.resolve(src))])
+        deps = self.dep_cache.get(key)
+        if deps is not None and (not self.compile_deps or self.stats.exists(obj.real_path)):
+            return _async.AsyncTask(deps)
+        def run() -> _t.Generator[None, None, _t.List[_Path]]:
+            if self.compile_deps:
+                obj.real_path.parent.mkdir(parents=True, exist_ok=True)
+                yield from self._run_build(obj)
+                deps = read_dep_file(dep_file_path(obj.real_path))
             else:
-                priv_built = _built
+                deps = yield from run_c_cpp_deps(compiler, [], src, self.verbosity).yfvalue
+            self.dep_cache.put(key, src, deps)
+            return deps
+        return _async.AsyncTask(run())
 
-            target = self.get_target(target_path)
+    # compile src to obj, writing its make rule to dep_file_path(obj.real_path)
+    def compile(self, obj: TargetFile, compiler: str, flags: _t.Sequence[_t.Any], src: _Path) -> _async.AsyncTask[None]:
+        dep_file = dep_file_path(obj.real_path)
+        cmd = [compiler, *flags, '-MMD', '-MF', dep_file, '-c', '-o', obj.real_path, src]
+        cache = self.obj_cache
+        if cache is None:
+            return run_process(*cmd, verbosity=self.verbosity)
+        def run() -> None:
+            key = cache.key(compiler, flags, src, self.digests)
+            if cache.fetch(key, obj.real_path, dep_file, self.digests):
+                self.count('object cache hits')
+                if self.verbosity > 0:
+                    print('cached', _sh.quote(str(obj.real_path)), file=_sys.stderr)
+                return
+            self.count('object cache misses')
+            check_process(*cmd, verbosity=self.verbosity)
+            cache.store(key, obj.real_path, read_dep_file(dep_file), self.digests)
+        return _async.SyncTask(run, name=f"compile {src}").as_async
 
-            if target_path.resolve() in priv_built:
-                return target.real_path.stat()
+    # persist anything learned during this run for the next one
+    def save(self) -> None:
+        self.dep_cache.save()
+        self.digests.save()
+        self.durations.save()
+        self.peak_rss.save()
+        self.unity.save()
+        self.tests.save()
+        if self.obj_cache is not None:
+            self.obj_cache.trim()
 
-            deps = yield from target.get_deps().yfvalue
-            active: _t.List[_async.AsyncTask[_os.stat_result]]=[]
+    # source files (anything not built) seen while checking targets
+    def source_files(self) -> _t.List[_Path]:
+        return [t.key_path for t in self.targets.values() if not t.is_build_target()]
+
+    # (mtime_ns, size) of the source files as this run saw them, None if one
+    # didn't exist. Watching from these rather than from a fresh look once the
+    # build is over catches edits made while it ran
+    def source_stats(self) -> _t.Dict[_Path, _t.Optional[_t.Tuple[int, int]]]:
+        ret: _t.Dict[_Path, _t.Optional[_t.Tuple[int, int]]] = {}
+        for target in self.targets.values():
+            if target.is_build_target():
+                continue
+            try:
+                st = self.stats.cached(target.real_path)
+            except KeyError:
+                continue
+            ret[target.key_path] = None if st is None else (st.st_mtime_ns, st.st_size)
+        return ret
+
+    # Forgets this run's results for everything depending on the changed files
+    # so the next build checks them again, the rest are still known current
+    def invalidate(self, changed: _t.Iterable[_Path]) -> None:
+        changed = list(changed)
+        by_real = {t.real_path: t for t in self.targets.values()}
+        dependents: _t.Dict[_Path, _t.List[TargetFile]] = {}
+        for path, deps in self.target_deps.items():
+            if path not in by_real:
+                continue
             for d in deps:
-                active.append(self.build(d, _built=priv_built))
-            dep_stats = yield from _async.AsyncTask.yf_all(active)
-            newest = it_max(st.st_mtime for st in dep_stats)
-            if target.real_path.exists() and (newest is None or target.real_path.stat().st_mtime >= newest):
-                return target.real_path.stat()
+                if d in by_real:
+                    dependents.setdefault(by_real[d].key_path, []).append(by_real[path])
+        self.stats.forget(changed, self.build_dir)
+        changed_keys = set(self.stats.resolve(p) for p in changed)
+        # failed or cancelled last time, try again
+        for target in self.targets.values():
+            with self._lck:
+                build_task = self._build_tasks.get(target.key_path)
+            deps_task = get_cached(target, 'get_deps')
+            if any(t is not None and t.exception is not None for t in (build_task, deps_task)):
+                with self._lck:
+                    self._build_tasks.pop(target.key_path, None)
+                clear_cached(target, 'get_deps')
+        pending = [t for t in self.targets.values() if t.key_path in changed_keys]
+        affected: _t.Set[_Path] = set()
+        while len(pending):
+            target = pending.pop()
+            if target.key_path in affected:
+                continue
+            affected.add(target.key_path)
+            with self._lck:
+                self._build_tasks.pop(target.key_path, None)
+            clear_cached(target, 'get_deps')
+            pending.extend(dependents.get(target.key_path, []))
+        self.count('targets invalidated', len(affected))
 
-            assert target_path.resolve() not in priv_built
-            target.real_path.parent.mkdir(parents=True, exist_ok=True)
-            yield from target.build().yfvalue
-            priv_built.add(target_path.resolve())
+    # start another build on the same target graph, forgetting the last
+    # run's results (files may have changed since) but keeping the targets
+    # and the deps of anything not invalidated
+    def new_run(self) -> None:
+        with self._lck:
+            self._build_tasks = {}
+        self.reset_stats()
+        self.stats.forget([], self.build_dir)
 
-            return target.real_path.stat()
+    # forget the last run's counters and timings, what -v and --trace report
+    def reset_stats(self) -> None:
+        self.counters = {}
+        self.build_times = {}
 
-        return _async.AsyncTask(run())
+    # Builds root_targets (and everything they need) as one run, sharing
+    # every target they have in common. Unless keep_going is set the first
+    # failure cancels the rest of the run, queued jobs are dropped and running
+    # processes killed. Every failure is in self.failures afterwards, the
+    # first is raised
+    def run(self) -> _t.List[_os.stat_result]:
+        self.failures = []
+        self.tests.runs = {}
+        self._cancel = _async.CancelToken()
+        def run_all() -> _t.Generator[None, None, _t.List[_os.stat_result]]:
+            roots = [self.get_target(p) for p in self.root_targets]
+            if self.prepare is not None:
+                found = []
+                for root in roots:
+                    try:
+                        yield from root.get_deps().yfvalue
+                        found.append(root)
+                    except Exception:
+                        # reported when the root is built
+                        pass
+                self.prepare(found)
+            return (yield from _async.AsyncTask.yf_all([self.build(p) for p in self.root_targets]))
+        with _async.cancel_scope(self._cancel):
+            task: _async.AsyncTask[_t.List[_os.stat_result]] = _async.AsyncTask(run_all())
+        try:
+            return task.value
+        except Exception:
+            if len(self.failures):
+                raise self.failures[0][1]
+            raise
+
+    def _failed(self, target: TargetFile, err: Exception) -> None:
+        if isinstance(err, _async.Cancelled):
+            return
+        with self._lck:
+            # a failure is seen again by everything depending on it
+            if any(e is err for _, e in self.failures):
+                return
+            self.failures.append((target, err))
+        self.count('targets failed')
+        if not self.keep_going:
+            self._cancel.cancel()
+
+    # this run's build task for path, None if nothing asked for it
+    def build_task(self, path: _Path) -> _t.Optional[_async.AsyncTask[_os.stat_result]]:
+        key = self.stats.resolve(path)
+        with self._lck:
+            return self._build_tasks.get(key)
+
+    # digest of the content of every source file the real path was built from
+    # (as found by this run's checks) and extra, eg. the flags used
+    def closure_digest(self, path: _Path, extra: _t.Sequence[_t.Any]=()) -> str:
+        seen: _t.Set[_Path] = set()
+        pending = [path]
+        srcs: _t.List[_Path] = []
+        while len(pending):
+            p = pending.pop()
+            if p in seen:
+                continue
+            seen.add(p)
+            deps = self.target_deps.get(p)
+            if deps:
+                pending.extend(deps)
+            elif self.stats.exists(p):
+                srcs.append(p)
+        material = [[str(e) for e in extra], sorted(self.digests.inputs(srcs).items())]
+        return _hl.sha256(_json.dumps(material).encode()).hexdigest()
+
+    def count(self, name: str, n: int=1) -> None:
+        with self._lck:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def expected_duration(self, target: TargetFile) -> float:
+        duration = self.durations.get(target.real_path)
+        if duration is None:
+            return target.estimate_duration()
+        return duration
+
+    # memory estimate for target's jobs, 0 until it has been built once
+    def expected_rss(self, target: TargetFile) -> int:
+        return int(self.peak_rss.get(target.real_path) or 0)
+
+    # every requester of a target shares the one build task, so each node is
+    # checked (and built if stale) at most once per run.
+    # path_cost is the expected time from this target finishing to the root
+    # target being built, targets on the longest path are scheduled first
+    def build(self, target_path: _Path, *, path_cost: float=0.0) -> _async.AsyncTask[_os.stat_result]:
+        key = self.stats.resolve(target_path)
+        priority = path_cost + self.expected_duration(self.get_target(target_path))
+        with self._lck:
+            task = self._build_tasks.get(key)
+            if task is None:
+                task = _async.AsyncTask(self._build(target_path))
+                task.priority = priority
+                self._build_tasks[key] = task
+            else:
+                task.priority = max(task.priority, priority)
+        self.count('build requests')
+        return task
+
+    def _build(self, target_path: _Path) -> _t.Generator[None, None, _os.stat_result]:
+        target = self.get_target(target_path)
+        self.count('targets checked')
+
+        try:
+            deps = yield from target.get_deps().yfvalue
+        except Exception as err:
+            self._failed(target, err)
+            raise
+        self.target_deps[target.real_path] = [self.get_real_path(d) for d in deps]
+        active = [self.build(d, path_cost=_async.current_priority()) for d in deps]
+        dep_stats = yield from _async.AsyncTask.yf_all(active)
+        newest = it_max(st.st_mtime for st in dep_stats)
+        target_stat = self.stats.stat(target.real_path)
+        if target_stat is not None and (newest is None or target_stat.st_mtime >= newest):
+            return target_stat
+
+        # newer deps with the same content as the last build (eg. a relinked
+        # object that came out byte identical) don't need a rebuild
+        inputs: _t.Optional[_t.Dict[str, str]] = None
+        if self.early_cutoff:
+            inputs = self.digests.inputs(self.get_real_path(d) for d in deps)
+            if target_stat is not None and self.digests.get_inputs(target.real_path) == inputs:
+                self.count('early cutoffs')
+                return target_stat
+
+        target.real_path.parent.mkdir(parents=True, exist_ok=True)
+        yield from self._run_build(target)
+        if inputs is not None:
+            self.digests.set_inputs(target.real_path, inputs)
+        else:
+            # a later --early-cutoff run mustn't compare against the build before this one
+            self.digests.drop_inputs(target.real_path)
+
+        target_stat = self.stats.stat(target.real_path)
+        if target_stat is None:
+            raise FileNotFoundError(f"Build did not create target: {target.real_path}")
+        return target_stat
+
+    def _run_build(self, target: TargetFile) -> _t.Generator[None, None, None]:
+        # time spent running the target's jobs, not waiting for a worker
+        spans: _t.List[_t.Tuple[float, float]] = []
+        peak_rss = [0]
+        def on_exec(s: float, e: float, rss: int) -> None:
+            spans.append((s, e))
+            peak_rss[0] = max(peak_rss[0], rss)
+        start = _time.perf_counter()
+        with _async.exec_hook(on_exec), _async.job_memory(self.expected_rss(target)):
+            task = target.build()
+        try:
+            yield from task.yfvalue
+        except BaseException as err:
+            # anything left behind is partial, don't let the next run take it as up to date
+            target.real_path.unlink(missing_ok=True)
+            if isinstance(err, Exception):
+                self._failed(target, err)
+            raise
+        finally:
+            self.stats.invalidate(target.real_path)
+        end = _time.perf_counter()
+        if len(spans):
+            start = min(s for s, _ in spans)
+            end = max(e for _, e in spans)
+        self.durations.put(target.real_path, sum(e - s for s, e in spans) if len(spans) else end - start)
+        if peak_rss[0] > 0:
+            self.peak_rss.put(target.real_path, peak_rss[0])
+        self.build_times[target.real_path] = (start, end)
+        self.count('targets built')
+        tracer = _async.get_tracer()
+        if tracer is not None:
+            tracer.complete(str(target.real_path), 'target', start, end)
+
+    # targets built this run from the root finished last back, each one the
+    # dep that finished last
+    def critical_path(self) -> _t.List[_Path]:
+        ret: _t.List[_Path] = []
+        roots = [r for r in (self.get_real_path(t) for t in self.root_targets) if r in self.build_times]
+        path: _t.Optional[_Path] = max(roots, key=lambda r: self.build_times[r][1]) if len(roots) else None
+        while path is not None:
+            ret.append(path)
+            built = [d for d in self.target_deps.get(path, []) if d in self.build_times]
+            path = max(built, key=lambda d: self.build_times[d][1]) if len(built) else None
+        return [p for p in ret if p in self.build_times]
+
+    def print_timings(self, *, top: int=10, file: _t.TextIO=_sys.stderr) -> None:
+        def duration(path: _Path) -> float:
+            start, end = self.build_times[path]
+            return end - start
+        print('slowest targets:', file=file)
+        for path in sorted(self.build_times, key=duration, reverse=True)[:top]:
+            print(f"  {duration(path):8.3f}s {path}", file=file)
+        crit = self.critical_path()
+        if len(crit):
+            start = min(self.build_times[p][0] for p in crit)
+            end = max(self.build_times[p][1] for p in crit)
+            print(f"critical path ({end - start:.3f}s):", file=file)
+            for path in crit:
+                print(f"  {duration(path):8.3f}s {path}", file=file)
 
 def build_target(suffix: str) -> _t.Callable[[_t.Type[TargetFile]], _t.Type[TargetFile]]:
     def dec(cls: _t.Type[TargetFile]) -> _t.Type[TargetFile]:
@@ -153,131 +942,141 @@ def build_target(suffix: str) -> _t.Callable[[_t.Type[TargetFile]], _t.Type[Targ
         return cls
     return dec
 
+_dep_continuation = _re.compile(r'\\\r?\n')
+# runs of escaped chars, $$ and anything but whitespace or backslash
+_dep_token = _re.compile(r'(?:\\.|\$\$|[^\s\\])+')
+_dep_escape = _re.compile(r'\\([ \t#\\])|\$(\$)')
+
+def _unescape_dep(tok: str) -> str:
+    return _dep_escape.sub(lambda m: m.group(1) or m.group(2), tok)
+
+# deps of each make rule in output (one per source when the compiler was given
+# several), a rule can have several targets ahead of the ':'
+def _parse_dep_rules(output: str) -> _t.List[_t.List[_Path]]:
+    rules: _t.List[_t.List[_Path]] = []
+    for line in _dep_continuation.sub(' ', output).splitlines():
+        toks = _dep_token.findall(line)
+        for i, tok in enumerate(toks):
+            if tok.endswith(':'):
+                rules.append([_Path(_unescape_dep(d)) for d in toks[i + 1:]])
+                break
+    return rules
+
 def _parse_dep_output(output: str) -> _t.List[_Path]:
-    in_sep = False
-    parts = ['']
-    while len(output):
-        if output[0] == '\\':
-            output = output[1:]
-            if in_sep and output[0].isspace():
-                output = output[1:]
-                continue
-            else:
-                in_sep = False
-        elif output[0].isspace():
-            if not in_sep:
-                parts.append('')
-            in_sep = True
-            output = output[1:]
-            continue
-        in_sep = False
-        parts[-1] += output[0]
-        output = output[1:]
-    return [_Path(s) for s in parts[1:]]
+    rules = _parse_dep_rules(output)
+    return rules[0] if len(rules) else []
+
+# make rule written by the compiler alongside obj with -MMD -MF
+def dep_file_path(obj: _Path) -> _Path:
+    return obj.parent / f"{obj.name}.d"
+
+def read_dep_file(path: _Path) -> _t.List[_Path]:
+    with path.open('r') as f:
+        return _parse_dep_output(f.read().strip())
+
+# deps of each of paths from one -MM run. The driver still runs cc1 once per
+# source so this saves little over separate runs (see bench.py deps-scan)
+def c_cpp_deps_batch(compiler: str, args: _t.Sequence[str], paths: _t.Sequence[_t.Union[str, _Path]], verbosity: int=0) -> _t.List[_t.List[_Path]]:
+    cmd = [compiler]
+    cmd += args
+    cmd += ['-MM', '-MG', '-fdiagnostics-color', *[str(p) for p in paths]]
+    if verbosity > 1:
+        print(*[_sh.quote(c) for c in cmd], file=_sys.stderr)
+    output = check_output(cmd)
+    rules = _parse_dep_rules(output.strip())
+    # one rule per source, in the order given
+    assert len(rules) == len(paths), f"expected {len(paths)} rules from: {' '.join(cmd)}"
+    return rules
 
 def run_c_cpp_deps(compiler: str, args: _t.Sequence[str], path: _t.Union[str, _Path], verbosity: int=0) -> _async.AsyncTask[_t.List[_Path]]:
-    def run() -> _t.List[_Path]:
-        src = _Path(path)
-        cmd = [compiler]
-        cmd += args
-        cmd += ['-MM', '-MG', '-fdiagnostics-color', str(src)]
-        if verbosity > 1:
-            print(*[_sh.quote(c) for c in cmd], file=_sys.stderr)
-        output = _sp.check_output(args=cmd, encoding='utf-8', stderr=_sp.PIPE)
-        assert isinstance(output, str)
-        output = output.strip()
-        return _parse_dep_output(output)
-    return _async.SyncTask(run).as_async
+    return _async.SyncTask(lambda: c_cpp_deps_batch(compiler, args, [path], verbosity)[0], name=f"{compiler} -MM {path}").as_async
+
+# proc.communicate() for a binary proc, reaping it with wait4 rather than
+# waitpid to report its peak RSS for the running job (see BuildEnv.peak_rss)
+def _communicate(proc: '_sp.Popen[bytes]') -> _t.Tuple[str, _t.Optional[str]]:
+    pipes = [f for f in (proc.stdout, proc.stderr) if f is not None]
+    bufs: _t.Dict[int, bytearray] = {f.fileno(): bytearray() for f in pipes}
+    with _sel.DefaultSelector() as sel:
+        for f in pipes:
+            sel.register(f, _sel.EVENT_READ)
+        while len(sel.get_map()):
+            for key, _ in sel.select():
+                data = _os.read(key.fd, 1 << 16)
+                if data == b'':
+                    sel.unregister(key.fileobj)
+                else:
+                    bufs[key.fd] += data
+    try:
+        _, status, usage = _os.wait4(proc.pid, 0)
+        proc.returncode = _os.waitstatus_to_exitcode(status)
+        # kilobytes on linux, and at least what the parent had at a vfork
+        _async.report_rss(usage.ru_maxrss * 1024)
+    except ChildProcessError:
+        # already reaped by a terminate() on cancel
+        proc.wait()
+    def text(f: _t.Optional[_t.IO[bytes]]) -> _t.Optional[str]:
+        return None if f is None else bufs[f.fileno()].decode('utf-8', errors='replace')
+    return text(proc.stdout) or '', text(proc.stderr)
+
+# subprocess.check_output with stderr captured (or sent to stdout with
+# stderr=subprocess.STDOUT), killed if the task running it is cancelled
+def check_output(cmd: _t.List[str], *, stderr: int=_sp.PIPE) -> str:
+    token = _async.current_cancel_token()
+    with _sp.Popen(cmd, stdout=_sp.PIPE, stderr=stderr) as proc:
+        remove = None if token is None else token.on_cancel(proc.terminate)
+        try:
+            out, err = _communicate(proc)
+        finally:
+            if remove is not None:
+                remove()
+    if token is not None and token.cancelled:
+        raise _async.Cancelled()
+    if proc.returncode != 0:
+        raise _sp.CalledProcessError(proc.returncode, cmd, out, err)
+    return out
 
+def check_process(*args: _t.Any, verbosity: int=0) -> None:
+    cmd = [str(a) for a in args]
+    if verbosity > 0:
+        print(*[_sh.quote(c) for c in cmd], file=_sys.stderr)
+    out = check_output(cmd).strip()
+    if verbosity > 0 and out != '':
+        print(out, file=_sys.stderr)
 
 def run_process(*args: _t.Any, verbosity: int=0) -> _async.AsyncTask[None]:
-    def run() -> None:
-        cmd = [str(a) for a in args]
-        if verbosity > 0:
-            print(*[_sh.quote(c) for c in cmd], file=_sys.stderr)
-        out = _sp.check_output(args=cmd, encoding='utf-8', stderr=_sp.PIPE).strip()
-        if verbosity > 0 and out != '':
-            print(out, file=_sys.stderr)
-    return _async.SyncTask(run).as_async
-
-# TODO: does this belong here? might deserve it's own file and documentation... I don't remember how this works and what the output format is exacly anymore
-def run_jbin_build(hex_path: _Path, jbin_path: _Path, verbosity: int=0) -> _async.AsyncTask[None]:
+    return _async.SyncTask(lambda: check_process(*args, verbosity=verbosity), name=' '.join(str(a) for a in args)).as_async
+
+# converts hex_path to out_path with convert, hex_to_jbin by default (eg.
+# jbin.hex_to_sbin for an sbin), a partly written out_path is removed on failure
+def run_jbin_build(hex_path: _Path, out_path: _Path, verbosity: int=0, *, convert: _t.Callable[[_Path, _Path], None]=_jbin.hex_to_jbin) -> _async.AsyncTask[None]:
+    name = f"hex-{out_path.suffix[1:]}"
     def run() -> None:
         if verbosity > 0:
-            print('hex-jbin', _sh.quote(str(hex_path)), _sh.quote(str(jbin_path)), file=_sys.stderr)
+            print(name, _sh.quote(str(hex_path)), _sh.quote(str(out_path)), file=_sys.stderr)
         try:
-            with hex_path.open('r') as hex_file, jbin_path.open('w') as jbin_file:
-                # Intel hex decoder
-                # https://en.wikipedia.org/wiki/Intel_HEX
-                decoded: _t.Dict[_t.Union[int, str], _t.Union[int, bytes]] = {}
-                offset = 0
-                for line in hex_file:
-                    line = line.strip()
-                    if line == '':
-                        continue
-                    assert line[:1] == ':'
-                    assert len(line) >= 11
-                    count = int(line[1:3], 16)
-                    addr = int(line[3:7], 16)
-                    rectype = int(line[7:9], 16)
-                    hex_data = line[9:-2]
-                    assert len(hex_data) == count * 2, f"count={count:x} addr={addr:x} rectype={rectype:x} line={line}"
-                    data = bytes.fromhex(hex_data)
-                    assert len(data) == count
-                    checksum = int(line[-2:], 16)
-                    if rectype == 0x00: # Data
-                        decoded[offset + addr] = data
-                    elif rectype == 0x01: # End Of File
-                        assert count == 0
-                        break
-                    elif rectype == 0x02: # Extended Segment Address
-                        assert count == 0
-                        offset = int(hex_data, 16) * 16
-                    elif rectype == 0x03: # Start Segment Address
-                        assert count == 4
-                        decoded['.text-start'] = int(hex_data[:4], 16)
-                        decoded['.pc-start'] = int(hex_data[4:])
-                    elif rectype == 0x04: # Extended Linear Address
-                        assert count == 2
-                        offset = (offset & 0xffff) | int(hex_data, 16) << 16
-                    elif rectype == 0x05: # Start Linear Address
-                        assert count == 4
-                        decoded['.pc-start'] = int(hex_data, 16)
-
-                # Sort and merge data
-                data_segs = [k for k in decoded if isinstance(k, int)]
-                data_segs.sort()
-                prev_addr = None
-                data_dict = {}
-                for addr in data_segs:
-                    data_chunk = decoded[addr]
-                    assert isinstance(data_chunk, bytes)
-                    if prev_addr is not None and prev_addr + len(data_dict[prev_addr]) >= addr:
-                        data_dict[prev_addr] = data_dict[prev_addr][:addr - prev_addr] + data_chunk
-                    else:
-                        data_dict[addr] = data_chunk
-                        prev_addr = addr
-
-                jbin_file.write('{\n')
-                pc_start = decoded['.pc-start']
-                assert isinstance(pc_start, int)
-                jbin_file.write(f'\t"pc-start": "0x{pc_start:x}",\n')
-                if '.text-start' in decoded:
-                    text_start = decoded['.text-start']
-                    assert isinstance(text_start, int)
-                    jbin_file.write(f'\t"text-start": "0x{text_start:x}",\n')
-                jbin_file.write('\t"data":{\n')
-                first = True
-                for addr in data_dict:
-                    if not first:
-                        jbin_file.write(',\n')
-                    data_chunk = data_dict[addr]
-                    assert isinstance(data_chunk, bytes)
-                    jbin_file.write(f'\t\t"0x{addr:08x}":"b64:{_b64.b64encode(data_chunk).decode()}"')
-                    first = False
-                jbin_file.write('\n\t}\n')
-                jbin_file.write('}\n')
+            convert(hex_path, out_path)
         except:
-            jbin_path.unlink()
+            out_path.unlink(missing_ok=True)
             raise
-    return _async.SyncTask(run).as_async
+    return _async.SyncTask(run, name=f"{name} {out_path}").as_async
+
+# brings archive up to date with objs, only adding the objects that changed
+# since it was last written and deleting members that are no longer in objs
+def run_archive_update(archive: _Path, objs: _t.Sequence[_Path], verbosity: int=0) -> _async.AsyncTask[None]:
+    def run() -> None:
+        try:
+            mtime = archive.stat().st_mtime_ns
+        except FileNotFoundError:
+            check_process('ar', 'rcs', archive, *objs, verbosity=verbosity)
+            return
+        # same mtime could still be newer with a coarse clock
+        stale = [o for o in objs if o.stat().st_mtime_ns >= mtime]
+        members = set(check_output(['ar', 't', str(archive)]).split())
+        gone = sorted(members - set(o.name for o in objs))
+        if len(gone):
+            check_process('ar', 'ds', archive, *gone, verbosity=verbosity)
+        if len(stale):
+            check_process('ar', 'rcs', archive, *stale, verbosity=verbosity)
+        # nothing to change, still mark it as current
+        _os.utime(archive)
+    return _async.SyncTask(run, name=f"ar {archive}").as_async
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import typecheck as _chk; _chk.check(__file__)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from builder import *
+from builder import _parse_dep_output, _parse_dep_rules
+from yfasync import AsyncTask
+from typing import *
+from pathlib import Path
+
+# Unit tests for builder's make rule parsing and for how BuildEnv keeps c
+# objects up to date, run as: builder_ut.py [-f] [-v]
+
+# Object compiled from the .c next to it with gcc, through BuildEnv's dep
+# scan and compile like build.py's c objects
+@build_target('.uto')
+class UtObj(TargetFile):
+    @property
+    def src(self) -> Path:
+        return self.virtual_path.with_suffix('.c')
+
+    def build(self) -> AsyncTask[None]:
+        return self.env.compile(self, 'gcc', [], self.src)
+
+    @cached
+    def get_deps(self) -> AsyncTask[List[Path]]:
+        return self.env.c_cpp_deps(self, 'gcc', self.src)
+
+class DepParseTest(unittest.TestCase):
+    def test_escaped_space(self) -> None:
+        self.assertEqual(_parse_dep_output(r'my\ src.o: my\ src.c a\ b.h'), [Path('my src.c'), Path('a b.h')])
+
+    def test_escaped_hash(self) -> None:
+        self.assertEqual(_parse_dep_output(r'a.o: a.c c\#d.h'), [Path('a.c'), Path('c#d.h')])
+
+    def test_dollar(self) -> None:
+        self.assertEqual(_parse_dep_output('a.o: a.c e$$f.h $$$$.h'), [Path('a.c'), Path('e$f.h'), Path('$$.h')])
+
+    def test_escaped_backslash(self) -> None:
+        self.assertEqual(_parse_dep_output('a.o: a.c x\\\\y.h'), [Path('a.c'), Path('x\\y.h')])
+
+    def test_continuations(self) -> None:
+        expected = [Path('a.c'), Path('b.h'), Path('c.h')]
+        self.assertEqual(_parse_dep_output('a.o: a.c \\\n b.h \\\n  c.h'), expected)
+        self.assertEqual(_parse_dep_output('a.o: a.c \\\r\n b.h \\\r\n  c.h\r\n'), expected)
+        # a continuation can end a line with no space ahead of it
+        self.assertEqual(_parse_dep_output('a.o: a.c\\\nb.h\\\r\nc.h'), expected)
+
+    def test_multiple_targets(self) -> None:
+        self.assertEqual(_parse_dep_output('a.o a.d: a.c b.h'), [Path('a.c'), Path('b.h')])
+        self.assertEqual(_parse_dep_output('a.o \\\n a\\ d.d: a.c b.h'), [Path('a.c'), Path('b.h')])
+
+    def test_no_rule(self) -> None:
+        self.assertEqual(_parse_dep_output(''), [])
+        self.assertEqual(_parse_dep_rules(''), [])
+
+    def test_batched_rules(self) -> None:
+        output = 'a.o: a.c \\\n x.h \\\n y.h\nb.o b.d: b.c\r\nc\\ d.o: c\\ d.c \\\r\n x.h\n'
+        self.assertEqual(_parse_dep_rules(output), [
+            [Path('a.c'), Path('x.h'), Path('y.h')],
+            [Path('b.c')],
+            [Path('c d.c'), Path('x.h')],
+        ])
+
+    @unittest.skipIf(shutil.which('gcc') is None, 'needs gcc')
+    def test_gcc_escapes(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp = Path(tmp_dir)
+            for name in ('a b.h', 'c#d.h', 'e$f.h'):
+                (tmp / name).touch()
+            (tmp / 'my src.c').write_text(''.join(f'#include "{n}"\n' for n in ('a b.h', 'c#d.h', 'e$f.h', 'missing gen.h')))
+            (tmp / 'plain.c').write_text('int x;\n')
+            self.assertEqual(c_cpp_deps_batch('gcc', [f"-I{tmp}"], [tmp / 'my src.c', tmp / 'plain.c']), [
+                [tmp / 'my src.c', tmp / 'a b.h', tmp / 'c#d.h', tmp / 'e$f.h', Path('missing gen.h')],
+                [tmp / 'plain.c'],
+            ])
+
+class StatCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self._tmp.name)
+        self.counters: Dict[str, int] = {}
+        self.stats = StatCache(self.count)
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+
+    def count(self, name: str, n: int) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def is_kept(self, path: Path) -> bool:
+        try:
+            self.stats.cached(path)
+            return True
+        except KeyError:
+            return False
+
+    def test_forget(self) -> None:
+        build_dir = self.dir / 'main.build'
+        (build_dir / '.obj').mkdir(parents=True)
+        (self.dir / 'main.build2').mkdir()
+        # the build dir reached through a link is still the build dir
+        (self.dir / 'link').symlink_to(build_dir)
+        kept = [self.dir / 'a.h', self.dir / 'main.build2' / 'b.h']
+        dropped = [self.dir / 'changed.h', build_dir / '.obj' / 'main.o', self.dir / 'link' / 'main', self.dir / 'missing.h']
+        for path in kept + dropped[:-1]:
+            path.touch()
+        for path in kept + dropped:
+            self.stats.stat(path)
+        self.stats.forget([self.dir / 'changed.h'], build_dir)
+        self.assertEqual([p for p in kept if not self.is_kept(p)], [])
+        self.assertEqual([p for p in dropped if self.is_kept(p)], [])
+        # what's kept isn't looked at again
+        self.stats.stat(kept[0])
+        self.assertEqual(self.counters.get('syscalls avoided'), 1)
+
+@unittest.skipIf(shutil.which('gcc') is None, 'needs gcc')
+class BuildEnvTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self._tmp.name)
+        self.root = self.dir / 'main.uto'
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+
+    # written with an mtime a minute back, so a later edit or build is
+    # newer whatever the timestamp granularity
+    def write(self, name: str, text: str) -> Path:
+        path = self.dir / name
+        path.write_text(text)
+        t = path.stat().st_mtime - 60
+        os.utime(path, (t, t))
+        return path
+
+    # a build as a separate build.py run would do it, starting from what
+    # the last one saved. The counters of the run
+    def run_build(self, *, compile_deps: bool=True) -> Dict[str, int]:
+        env = BuildEnv(self.root, build_dir=self.dir / 'main.build')
+        env.verbosity = 0
+        env.compile_deps = compile_deps
+        try:
+            env.run()
+        finally:
+            env.save()
+        self.obj = env.get_root_target().real_path
+        return env.counters
+
+    def test_header_change(self) -> None:
+        for compile_deps in (True, False):
+            with self.subTest(compile_deps=compile_deps):
+                self.write('main.c', '#include "a.h"\nint main(void) { return A; }\n')
+                self.write('a.h', '#include "b.h"\n')
+                b = self.write('b.h', '#define A 0\n')
+                shutil.rmtree(self.dir / 'main.build', ignore_errors=True)
+                self.assertEqual(self.run_build(compile_deps=compile_deps).get('targets built'), 1)
+                self.assertEqual(self.run_build(compile_deps=compile_deps).get('targets built'), None)
+                b.touch()
+                self.assertEqual(self.run_build(compile_deps=compile_deps).get('targets built'), 1)
+                self.assertEqual(self.run_build(compile_deps=compile_deps).get('targets built'), None)
+
+    def test_object_deleted(self) -> None:
+        self.write('main.c', '#include "a.h"\nint main(void) { return A; }\n')
+        a = self.write('a.h', '#define A 0\n')
+        self.assertEqual(self.run_build().get('targets built'), 1)
+        # the cached deps still match the sources, the object has to be
+        # built anyway, and its .d with it
+        for removed in ([self.obj], [self.obj, dep_file_path(self.obj)]):
+            with self.subTest(removed=[p.name for p in removed]):
+                for path in removed:
+                    path.unlink()
+                self.assertEqual(self.run_build().get('targets built'), 1)
+                self.assertTrue(self.obj.exists())
+                self.assertEqual(self.run_build().get('targets built'), None)
+        # and the deps read from the new .d are what it's checked against
+        a.touch()
+        self.assertEqual(self.run_build().get('targets built'), 1)
+
+    def test_missing_header_appears(self) -> None:
+        # only a scan can list a header that isn't there (-MG), compiling fails on it
+        self.write('main.c', '#include "gen.h"\nint main(void) { return GEN; }\n')
+        with self.assertRaises(Exception):
+            self.run_build(compile_deps=False)
+        self.write('gen.h', '#define GEN 0\n')
+        self.assertEqual(self.run_build(compile_deps=False).get('targets built'), 1)
+        self.assertEqual(self.run_build(compile_deps=False).get('targets built'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+import typecheck as _chk; _chk.check(__file__)
+
+import base64 as _b64
+import json as _json
+import mmap as _mmap
+import struct as _struct
+import typing as _t
+
+from pathlib import Path as _Path
+
+# Firmware image formats built from Intel HEX output:
+#   .jbin json with base64 segments, easy to read anywhere
+#   .sbin the same image as raw page aligned segments behind an index, so
+#         tools can mmap it and read a segment without decoding the file
+
+Buffer = _t.Union[bytes, bytearray, memoryview]
+
+def _hex_data(hex_file: _t.TextIO, starts: _t.Dict[str, int]) -> _t.Iterator[_t.Tuple[int, bytes]]:
+    # Intel hex decoder
+    # https://en.wikipedia.org/wiki/Intel_HEX
+    # yields (address, data) for data records, start addresses go in starts
+    offset = 0
+    for line in hex_file:
+        line = line.strip()
+        if line == '':
+            continue
+        assert line[:1] == ':'
+        assert len(line) >= 11
+        count = int(line[1:3], 16)
+        addr = int(line[3:7], 16)
+        rectype = int(line[7:9], 16)
+        hex_data = line[9:-2]
+        assert len(hex_data) == count * 2, f"count={count:x} addr={addr:x} rectype={rectype:x} line={line}"
+        data = bytes.fromhex(hex_data)
+        assert len(data) == count
+        checksum = int(line[-2:], 16)
+        if rectype == 0x00: # Data
+            yield offset + addr, data
+        elif rectype == 0x01: # End Of File
+            assert count == 0
+            break
+        elif rectype == 0x02: # Extended Segment Address
+            assert count == 0
+            offset = int(hex_data, 16) * 16
+        elif rectype == 0x03: # Start Segment Address
+            assert count == 4
+            starts['.text-start'] = int(hex_data[:4], 16)
+            starts['.pc-start'] = int(hex_data[4:])
+        elif rectype == 0x04: # Extended Linear Address
+            assert count == 2
+            offset = (offset & 0xffff) | int(hex_data, 16) << 16
+        elif rectype == 0x05: # Start Linear Address
+            assert count == 4
+            starts['.pc-start'] = int(hex_data, 16)
+
+# Merge records (which must be in ascending address order) into contiguous
+# segments. A record overlapping the end of the segment before it truncates
+# that segment at its address. Returns None if records are out of order.
+def _hex_segments(records: _t.Iterable[_t.Tuple[int, bytes]]) -> _t.Optional[_t.List[_t.Tuple[int, bytearray]]]:
+    segs: _t.List[_t.Tuple[int, bytearray]] = []
+    prev_addr: _t.Optional[int] = None
+    for addr, data in records:
+        if prev_addr is not None and addr <= prev_addr:
+            return None
+        prev_addr = addr
+        if len(segs) and segs[-1][0] + len(segs[-1][1]) >= addr:
+            seg_addr, seg = segs[-1]
+            del seg[addr - seg_addr:]
+            seg += data
+        else:
+            segs.append((addr, bytearray(data)))
+    return segs
+
+def read_hex(hex_path: _Path) -> _t.Tuple[_t.List[_t.Tuple[int, bytearray]], _t.Dict[str, int]]:
+    starts: _t.Dict[str, int] = {}
+    with hex_path.open('r') as hex_file:
+        segs = _hex_segments(_hex_data(hex_file, starts))
+    if segs is None:
+        # records out of order, sort them first (later records for an address win)
+        starts = {}
+        with hex_path.open('r') as hex_file:
+            records = dict(_hex_data(hex_file, starts))
+        segs = _hex_segments(sorted(records.items()))
+        assert segs is not None
+    return segs, starts
+
+# base64 of 3 byte multiples concatenates to the base64 of the whole
+_B64_CHUNK = 3 << 14
+
+# jbin is json, start addresses as hex strings and a data object mapping each
+# segment's address to its base64 contents prefixed with "b64:"
+def write_jbin(jbin_path: _Path, segs: _t.Iterable[_t.Tuple[int, Buffer]], starts: _t.Dict[str, int]) -> None:
+    with jbin_path.open('w') as jbin_file:
+        jbin_file.write('{\n')
+        pc_start = starts['.pc-start']
+        jbin_file.write(f'\t"pc-start": "0x{pc_start:x}",\n')
+        if '.text-start' in starts:
+            jbin_file.write(f'\t"text-start": "0x{starts[".text-start"]:x}",\n')
+        jbin_file.write('\t"data":{\n')
+        first = True
+        for addr, seg in segs:
+            if not first:
+                jbin_file.write(',\n')
+            jbin_file.write(f'\t\t"0x{addr:08x}":"b64:')
+            view = memoryview(seg)
+            for i in range(0, len(view), _B64_CHUNK):
+                jbin_file.write(_b64.b64encode(view[i:i + _B64_CHUNK]).decode())
+            jbin_file.write('"')
+            first = False
+        jbin_file.write('\n\t}\n')
+        jbin_file.write('}\n')
+
+def read_jbin(jbin_path: _Path) -> _t.Tuple[_t.List[_t.Tuple[int, bytes]], _t.Dict[str, int]]:
+    with jbin_path.open('r') as jbin_file:
+        doc = _json.load(jbin_file)
+    starts = {'.pc-start': int(doc['pc-start'], 16)}
+    if 'text-start' in doc:
+        starts['.text-start'] = int(doc['text-start'], 16)
+    segs = []
+    for addr, data in doc['data'].items():
+        assert data.startswith('b64:')
+        segs.append((int(addr, 16), _b64.b64decode(data[4:])))
+    return segs, starts
+
+def hex_to_jbin(hex_path: _Path, jbin_path: _Path) -> None:
+    write_jbin(jbin_path, *read_hex(hex_path))
+
+# sbin layout, all little endian:
+#   header  magic, version, flags, page size, segment count, pc start, text start
+#   index   (address, file offset, length) per segment, in address order
+#   data    each segment's bytes at a page aligned file offset
+SBIN_MAGIC = b'SBIN'
+SBIN_VERSION = 1
+SBIN_HAS_TEXT_START = 0x1
+_sbin_header = _struct.Struct('<4sHHIIQQ')
+_sbin_index = _struct.Struct('<QQQ')
+
+def write_sbin(sbin_path: _Path, segs: _t.Sequence[_t.Tuple[int, Buffer]], starts: _t.Dict[str, int], *, page_size: int=4096) -> None:
+    flags = SBIN_HAS_TEXT_START if '.text-start' in starts else 0
+    offset = _sbin_header.size + _sbin_index.size * len(segs)
+    index = []
+    for addr, seg in segs:
+        offset = -(-offset // page_size) * page_size
+        index.append((addr, offset, len(seg)))
+        offset += len(seg)
+    with sbin_path.open('wb') as sbin_file:
+        sbin_file.write(_sbin_header.pack(SBIN_MAGIC, SBIN_VERSION, flags, page_size, len(segs), starts['.pc-start'], starts.get('.text-start', 0)))
+        for entry in index:
+            sbin_file.write(_sbin_index.pack(*entry))
+        for (_, seg_offset, _), (_, seg) in zip(index, segs):
+            sbin_file.write(bytes(seg_offset - sbin_file.tell()))
+            sbin_file.write(seg)
+
+class SBinFile:
+    """Read only mmap of a .sbin, segments are memoryviews into the mapping
+    so nothing is copied until they are used. Use as a context manager or
+    close() when done, segment views are released then and can't be used
+    after (copy with bytes() to keep one)."""
+    starts: _t.Dict[str, int]
+    page_size: int
+    # (address, file offset, length)
+    index: _t.List[_t.Tuple[int, int, int]]
+    _map: _mmap.mmap
+    # the view of the whole map the segments are sliced from and each
+    # segment's view, made once and kept until close, the map can't be
+    # closed while any are alive
+    _map_view: _t.Optional[memoryview]
+    _views: _t.Dict[int, memoryview]
+
+    def __init__(self, path: _Path) -> None:
+        with path.open('rb') as f:
+            self._map = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        self._map_view = None
+        self._views = {}
+        magic, version, flags, self.page_size, nsegs, pc_start, text_start = _sbin_header.unpack_from(self._map)
+        if magic != SBIN_MAGIC or version != SBIN_VERSION:
+            self._map.close()
+            raise ValueError(f"Not a version {SBIN_VERSION} sbin file: {path}")
+        self.starts = {'.pc-start': pc_start}
+        if flags & SBIN_HAS_TEXT_START:
+            self.starts['.text-start'] = text_start
+        self.index = [_sbin_index.unpack_from(self._map, _sbin_header.size + i * _sbin_index.size) for i in range(nsegs)]
+
+    def __enter__(self) -> 'SBinFile':
+        return self
+
+    def __exit__(self, *args: _t.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # the slices first, they hold exports on the map's view
+        for view in self._views.values():
+            view.release()
+        self._views = {}
+        if self._map_view is not None:
+            self._map_view.release()
+            self._map_view = None
+        self._map.close()
+
+    def segment(self, i: int) -> _t.Tuple[int, memoryview]:
+        addr, offset, length = self.index[i]
+        seg = self._views.get(i)
+        if seg is None:
+            if self._map_view is None:
+                self._map_view = memoryview(self._map)
+            seg = self._views[i] = self._map_view[offset:offset + length]
+        return addr, seg
+
+    @property
+    def segments(self) -> _t.Iterator[_t.Tuple[int, memoryview]]:
+        return (self.segment(i) for i in range(len(self.index)))
+
+def hex_to_sbin(hex_path: _Path, sbin_path: _Path) -> None:
+    write_sbin(sbin_path, *read_hex(hex_path))
+
+def jbin_to_sbin(jbin_path: _Path, sbin_path: _Path) -> None:
+    write_sbin(sbin_path, *read_jbin(jbin_path))
+
+def sbin_to_jbin(sbin_path: _Path, jbin_path: _Path) -> None:
+    with SBinFile(sbin_path) as sbin:
+        write_jbin(jbin_path, sbin.segments, sbin.starts)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert between .jbin and .sbin images')
+    parser.add_argument('src', type=_Path)
+    parser.add_argument('dst', type=_Path)
+    args = parser.parse_args()
+
+    converters = {
+        ('.jbin', '.sbin'): jbin_to_sbin,
+        ('.sbin', '.jbin'): sbin_to_jbin,
+        ('.hex', '.jbin'): hex_to_jbin,
+        ('.hex', '.sbin'): hex_to_sbin,
+    }
+    convert = converters.get((args.src.suffix, args.dst.suffix))
+    if convert is None:
+        parser.error(f"Can't convert {args.src.suffix} to {args.dst.suffix}")
+    convert(args.src, args.dst)
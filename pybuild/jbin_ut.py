@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import typecheck as _chk; _chk.check(__file__)
+
+import random
+import tempfile
+import unittest
+
+from jbin import *
+from typing import *
+from pathlib import Path
+
+# Unit tests for the hex, jbin and sbin conversions, run as: jbin_ut.py [-f] [-v]
+
+# Intel HEX record with its checksum
+def hex_record(rectype: int, addr: int, data: bytes) -> str:
+    body = bytes([len(data), addr >> 8, addr & 0xff, rectype]) + data
+    return f":{body.hex().upper()}{(-sum(body)) & 0xff:02X}\n"
+
+# segs as Intel HEX, record_size bytes a record with extended linear
+# address records where the upper 16 bits change
+def hex_image(segs: List[Tuple[int, bytes]], pc_start: int, *, record_size: int=16, shuffle: bool=False) -> str:
+    records: List[List[str]] = []
+    for seg_addr, data in segs:
+        for i in range(0, len(data), record_size):
+            addr = seg_addr + i
+            records.append([
+                hex_record(0x04, 0, (addr >> 16).to_bytes(2, 'big')),
+                hex_record(0x00, addr & 0xffff, data[i:i + record_size]),
+            ])
+    if shuffle:
+        random.Random(1).shuffle(records)
+    lines = [line for record in records for line in record]
+    lines.append(hex_record(0x05, 0, pc_start.to_bytes(4, 'big')))
+    lines.append(hex_record(0x01, 0, b''))
+    return ''.join(lines)
+
+class JBinTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self._tmp.name)
+        rng = random.Random(0)
+        # crossing a 64K boundary, and with a gap between segments
+        self.segs = [
+            (0x8000_fff0, bytes(rng.randrange(256) for _ in range(1000))),
+            (0x8010_0000, bytes(rng.randrange(256) for _ in range(37))),
+            (0x9000_0000, bytes(rng.randrange(256) for _ in range(5000))),
+        ]
+        self.pc_start = 0x8000_fff0
+        self.hex = self.dir / 'image.hex'
+        self.hex.write_text(hex_image(self.segs, self.pc_start))
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+
+    def test_read_hex(self) -> None:
+        segs, starts = read_hex(self.hex)
+        self.assertEqual([(a, bytes(d)) for a, d in segs], self.segs)
+        self.assertEqual(starts, {'.pc-start': self.pc_start})
+
+    def test_out_of_order_records(self) -> None:
+        shuffled = self.dir / 'shuffled.hex'
+        shuffled.write_text(hex_image(self.segs, self.pc_start, shuffle=True))
+        hex_to_jbin(self.hex, self.dir / 'a.jbin')
+        hex_to_jbin(shuffled, self.dir / 'b.jbin')
+        self.assertEqual((self.dir / 'a.jbin').read_bytes(), (self.dir / 'b.jbin').read_bytes())
+
+    def test_round_trip(self) -> None:
+        jbin = self.dir / 'image.jbin'
+        sbin = self.dir / 'image.sbin'
+        direct_sbin = self.dir / 'direct.sbin'
+        round_trip = self.dir / 'round_trip.jbin'
+        hex_to_jbin(self.hex, jbin)
+        jbin_to_sbin(jbin, sbin)
+        sbin_to_jbin(sbin, round_trip)
+        hex_to_sbin(self.hex, direct_sbin)
+        self.assertEqual(jbin.read_bytes(), round_trip.read_bytes())
+        self.assertEqual(sbin.read_bytes(), direct_sbin.read_bytes())
+        segs, starts = read_jbin(round_trip)
+        self.assertEqual(segs, self.segs)
+        self.assertEqual(starts, {'.pc-start': self.pc_start})
+
+    def test_sbin_segments(self) -> None:
+        sbin = self.dir / 'image.sbin'
+        hex_to_sbin(self.hex, sbin)
+        with SBinFile(sbin) as f:
+            self.assertEqual(f.starts, {'.pc-start': self.pc_start})
+            self.assertEqual([(a, bytes(d)) for a, d in f.segments], self.segs)
+            for _, offset, _ in f.index:
+                self.assertEqual(offset % f.page_size, 0)
+
+    def test_close_with_segment_views(self) -> None:
+        sbin = self.dir / 'image.sbin'
+        hex_to_sbin(self.hex, sbin)
+        # closing used to raise BufferError while a view was still referenced
+        with SBinFile(sbin) as f:
+            _, view = f.segment(0)
+            segs = list(f.segments)
+            kept = bytes(view)
+        self.assertEqual(kept, self.segs[0][1])
+        with self.assertRaises(ValueError):
+            bytes(view)
+        with self.assertRaises(ValueError):
+            bytes(segs[1][1])
+
+    def test_segment_views_reused(self) -> None:
+        sbin = self.dir / 'image.sbin'
+        hex_to_sbin(self.hex, sbin)
+        with SBinFile(sbin) as f:
+            _, first = f.segment(2)
+            for _ in range(100):
+                self.assertIs(f.segment(2)[1], first)
+                list(f.segments)
+            self.assertEqual(len(f._views), len(f.index))
+
+    def test_not_sbin(self) -> None:
+        with self.assertRaises(ValueError):
+            SBinFile(self.hex)
+
+if __name__ == '__main__':
+    unittest.main()
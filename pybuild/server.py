@@ -0,0 +1,166 @@
+import typecheck as _chk; _chk.check(__file__)
+
+import json as _json
+import os as _os
+import socket as _socket
+import sys as _sys
+import traceback as _tb
+import typing as _t
+
+from pathlib import Path as _Path
+
+# Build server for build.py, one per build dir. It keeps the BuildEnv (target
+# graph, caches and thread pool) alive between builds, short lived build.py
+# clients send it their arguments plus their stdout/stderr over a unix socket
+# and get the exit status back. Builds are run one at a time.
+
+def socket_path(build_dir: _Path) -> _Path:
+    return build_dir / 'server.sock'
+
+# Handler gets the client's argv and returns the exit status, the client's
+# stdout/stderr are fds 1 and 2 while it runs
+Handler = _t.Callable[[_t.List[str]], int]
+
+class BuildServer:
+    path: _Path
+    idle_timeout: float
+    _handler: Handler
+
+    def __init__(self, path: _Path, handler: Handler, *, idle_timeout: float=600.0) -> None:
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self._handler = handler
+
+    # serves requests until nothing has come in for idle_timeout seconds or
+    # a client asks it to stop
+    def serve(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.unlink(missing_ok=True)
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        try:
+            sock.bind(str(self.path))
+            sock.listen()
+            sock.settimeout(self.idle_timeout)
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except _socket.timeout:
+                    return
+                with conn:
+                    conn.settimeout(None)
+                    if not self._serve_one(conn):
+                        return
+        finally:
+            sock.close()
+            self.path.unlink(missing_ok=True)
+
+    def _serve_one(self, conn: _socket.socket) -> bool:
+        msg, fds, _, _ = _socket.recv_fds(conn, 1 << 20, 2)
+        try:
+            req = _json.loads(msg)
+            if req.get('stop', False):
+                conn.sendall(_json.dumps({'status': 0}).encode() + b'\n')
+                return False
+            if req['cwd'] != _os.getcwd() or len(fds) != 2:
+                # not ours to serve, the client builds in process
+                conn.sendall(_json.dumps({'status': None}).encode() + b'\n')
+                return True
+            status = self._run(req['argv'], fds)
+            conn.sendall(_json.dumps({'status': status}).encode() + b'\n')
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            for fd in fds:
+                _os.close(fd)
+        return True
+
+    # runs the handler with the client's stdout/stderr as fds 1 and 2 so
+    # compiler output from subprocesses goes to the client's terminal as well
+    def _run(self, argv: _t.List[str], fds: _t.List[int]) -> int:
+        saved = [_os.dup(1), _os.dup(2)]
+        _sys.stdout.flush()
+        _sys.stderr.flush()
+        _os.dup2(fds[0], 1)
+        _os.dup2(fds[1], 2)
+        try:
+            return self._handler(argv)
+        except SystemExit as ex:
+            return ex.code if isinstance(ex.code, int) else 1
+        except Exception:
+            _tb.print_exc()
+            return 1
+        finally:
+            _sys.stdout.flush()
+            _sys.stderr.flush()
+            _os.dup2(saved[0], 1)
+            _os.dup2(saved[1], 2)
+            _os.close(saved[0])
+            _os.close(saved[1])
+
+def _request(path: _Path, req: _t.Dict[str, _t.Any], fds: _t.List[int]) -> _t.Optional[int]:
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+        _socket.send_fds(sock, [_json.dumps(req).encode()], fds)
+        resp = b''
+        while not resp.endswith(b'\n'):
+            data = sock.recv(4096)
+            if data == b'':
+                # server went away mid build
+                return None
+            resp += data
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    status = _json.loads(resp)['status']
+    return status if isinstance(status, int) else None
+
+# Asks the server at path to run argv, returns its exit status or None when
+# there is no server (or it can't serve this client) and the build should
+# run in process
+def request_build(path: _Path, argv: _t.List[str]) -> _t.Optional[int]:
+    if not path.exists():
+        return None
+    _sys.stdout.flush()
+    _sys.stderr.flush()
+    return _request(path, {'argv': argv, 'cwd': _os.getcwd()}, [1, 2])
+
+def stop_server(path: _Path) -> bool:
+    if not path.exists():
+        return False
+    return _request(path, {'stop': True}, []) is not None
+
+def server_running(path: _Path) -> bool:
+    if not path.exists():
+        return False
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+# Forks a detached server process, returns True in the server and False in
+# the caller. The server's own output goes to log_path
+def daemonize(log_path: _Path) -> bool:
+    _sys.stdout.flush()
+    _sys.stderr.flush()
+    pid = _os.fork()
+    if pid != 0:
+        _os.waitpid(pid, 0)
+        return False
+    _os.setsid()
+    if _os.fork() != 0:
+        _os._exit(0)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    log_fd = _os.open(log_path, _os.O_WRONLY | _os.O_CREAT | _os.O_APPEND, 0o644)
+    null_fd = _os.open(_os.devnull, _os.O_RDONLY)
+    _os.dup2(null_fd, 0)
+    _os.dup2(log_fd, 1)
+    _os.dup2(log_fd, 2)
+    _os.close(null_fd)
+    _os.close(log_fd)
+    return True
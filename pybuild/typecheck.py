@@ -0,0 +1,47 @@
+import hashlib as _hl
+import json as _json
+import os as _os
+import typing as _t
+
+from pathlib import Path as _Path
+
+# Runs mypycheck on a module only when the sources next to it have changed since
+# its last passing check, so start up doesn't pay for mypy on every run.
+# PYBUILD_TYPECHECK=1 always checks, PYBUILD_TYPECHECK=0 never does.
+
+def _sources_digest(src_dir: _Path) -> str:
+    h = _hl.sha256()
+    for path in sorted(src_dir.glob('*.py')):
+        h.update(path.name.encode())
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+def check(path: str) -> None:
+    mode = _os.environ.get('PYBUILD_TYPECHECK')
+    if mode == '0':
+        return
+    src = _Path(path).resolve()
+    digest = _sources_digest(src.parent)
+    stamp_path = src.parent / '__pycache__' / 'typecheck.json'
+    stamps: _t.Dict[str, str]
+    try:
+        with stamp_path.open('r') as f:
+            stamps = _json.load(f)
+    except (OSError, ValueError):
+        stamps = {}
+    if mode != '1' and stamps.get(src.name) == digest:
+        return
+
+    import mypycheck
+    mypycheck.check(str(src))
+
+    stamps[src.name] = digest
+    try:
+        stamp_path.parent.mkdir(exist_ok=True)
+        tmp = stamp_path.with_suffix(f".{_os.getpid()}.tmp")
+        with tmp.open('w') as f:
+            _json.dump(stamps, f)
+        tmp.replace(stamp_path)
+    except OSError:
+        # read only install, just check every time
+        pass
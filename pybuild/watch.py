@@ -0,0 +1,155 @@
+import typecheck as _chk; _chk.check(__file__)
+
+import ctypes as _ct
+import os as _os
+import select as _sel
+import struct as _struct
+import time as _time
+import typing as _t
+
+from pathlib import Path as _Path
+
+# File watchers for build.py --watch, wait() blocks until one of the watched
+# files changes and returns the ones that did. Use make_watcher() to get an
+# inotify watcher where available and a polling one otherwise.
+#
+# watch() is given the (mtime_ns, size) the build saw for the files it has
+# them for (None if it found none), anything different by then is a change
+# the build missed and is returned by the next wait().
+
+Seen = _t.Mapping[_Path, _t.Optional[_t.Tuple[int, int]]]
+
+class PollWatcher:
+    """Stats every watched file each interval seconds."""
+    interval: float
+    _stats: _t.Dict[_Path, _t.Optional[_t.Tuple[int, int]]]
+
+    def __init__(self, *, interval: float=0.02) -> None:
+        self.interval = interval
+        self._stats = {}
+
+    @staticmethod
+    def _stat(path: _Path) -> _t.Optional[_t.Tuple[int, int]]:
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def watch(self, paths: _t.Iterable[_Path], seen: Seen={}) -> None:
+        self._stats = {p: seen[p] if p in seen else self._stat(p) for p in paths}
+
+    def wait(self, timeout: _t.Optional[float]=None) -> _t.Set[_Path]:
+        end = None if timeout is None else _time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, st in self._stats.items():
+                new_st = self._stat(path)
+                if new_st != st:
+                    self._stats[path] = new_st
+                    changed.add(path)
+            if len(changed) or (end is not None and _time.monotonic() >= end):
+                return changed
+            _time.sleep(self.interval)
+
+    def close(self) -> None:
+        pass
+
+# from <sys/inotify.h>
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_CLOEXEC = _os.O_CLOEXEC
+_inotify_event = _struct.Struct('iIII')
+
+class InotifyWatcher:
+    """Watches the directories holding the watched files, so editors that save
+    by writing a new file and renaming it over the old one are still seen."""
+    _fd: int
+    _libc: _t.Any
+    _files: _t.Set[_Path]
+    _dirs: _t.Dict[int, _Path]
+    _dir_wds: _t.Dict[_Path, int]
+    # changed before their directory was watched, for the next wait
+    _missed: _t.Set[_Path]
+
+    def __init__(self) -> None:
+        self._libc = _ct.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(_ct.get_errno(), 'inotify_init1 failed')
+        self._files = set()
+        self._dirs = {}
+        self._dir_wds = {}
+        self._missed = set()
+
+    def watch(self, paths: _t.Iterable[_Path], seen: Seen={}) -> None:
+        self._files = set(p.absolute() for p in paths)
+        mask = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        new_dirs = set(p.parent for p in self._files) - set(self._dir_wds)
+        for d in new_dirs:
+            wd = self._libc.inotify_add_watch(self._fd, bytes(d), mask)
+            if wd < 0:
+                raise OSError(_ct.get_errno(), f"inotify_add_watch failed: {d}")
+            self._dirs[wd] = d
+            self._dir_wds[d] = wd
+        # the events for files in directories that weren't watched yet are
+        # lost, those already watched have theirs queued
+        for path, st in seen.items():
+            if path.parent in new_dirs and PollWatcher._stat(path) != st:
+                self._missed.add(path)
+
+    def _read(self) -> _t.Set[_Path]:
+        changed = set()
+        buf = _os.read(self._fd, 1 << 16)
+        i = 0
+        while i < len(buf):
+            wd, _, _, name_len = _inotify_event.unpack_from(buf, i)
+            i += _inotify_event.size
+            name = buf[i:i + name_len].rstrip(b'\0')
+            i += name_len
+            if wd in self._dirs:
+                path = self._dirs[wd] / _os.fsdecode(name)
+                if path in self._files:
+                    changed.add(path)
+        return changed
+
+    def wait(self, timeout: _t.Optional[float]=None) -> _t.Set[_Path]:
+        if len(self._missed):
+            missed = self._missed
+            self._missed = set()
+            return missed
+        end = None if timeout is None else _time.monotonic() + timeout
+        while True:
+            remaining = None if end is None else max(0.0, end - _time.monotonic())
+            ready, _, _ = _sel.select([self._fd], [], [], remaining)
+            if not len(ready):
+                return set()
+            changed = self._read()
+            if len(changed):
+                return changed
+
+    def close(self) -> None:
+        _os.close(self._fd)
+
+Watcher = _t.Union[PollWatcher, InotifyWatcher]
+
+def make_watcher() -> Watcher:
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        # no inotify (not linux, or no libc symbol), fall back to stat polling
+        return PollWatcher()
+
+# waits for a change then briefly for any more that come with it, editors
+# often write a file in several steps
+def wait_for_changes(watcher: Watcher, *, settle: float=0.01) -> _t.Set[_Path]:
+    changed = watcher.wait()
+    while True:
+        more = watcher.wait(settle)
+        if not len(more):
+            return changed
+        changed |= more
@@ -1,53 +1,198 @@
-import mypycheck as _chk; _chk.check(__file__)
+import typecheck as _chk; _chk.check(__file__)
 
-import inspect as _ins
-import multiprocessing as _mp
-import time as _time
+import collections as _col
+import heapq as _hq
+import json as _json
+import os as _os
 import threading as _thr
+import time as _time
+import types as _types
 import typing as _t
-import weakref as _wr
 
 T = _t.TypeVar('T')
 
+# start, end and peak RSS in bytes (0 if nothing reported one, see report_rss)
+ExecHook = _t.Callable[[float, float, int], None]
+
+class _TaskContext(_t.NamedTuple):
+    """What a task inherits from where it was created, and runs with (so
+    passes on to anything it starts) every time it is stepped. Never changed
+    in place, a task keeps the one current when it was made."""
+    priority: float = 0.0
+    exec_hook: _t.Optional[ExecHook] = None
+    job_memory: int = 0
+    cancel_token: _t.Optional['CancelToken'] = None
+
+class _ThreadState(_thr.local):
+    """Per thread state, the class attributes are the defaults in a new
+    thread (looking them up never raises, unlike getattr with a default)."""
+    context: _TaskContext = _TaskContext()
+    sync_task: _t.Optional['SyncTask[_t.Any]'] = None
+    waiting: _t.Optional[_t.Tuple[_t.Sequence['AsyncTask[_t.Any]'], int]] = None
+
+_tls = _ThreadState()
+
+class _context_setting:
+    """Within this, tasks created (and anything they go on to start) get
+    _changes in their context rather than the current values."""
+    _changes: _t.Dict[str, _t.Any]
+    _prev: _TaskContext
+
+    def __enter__(self) -> None:
+        self._prev = _tls.context
+        _tls.context = self._prev._replace(**self._changes)
+
+    def __exit__(self, *args: _t.Any) -> None:
+        _tls.context = self._prev
+
+# Priority given to new tasks, the priority of the task currently being stepped
+# so work started by a task is scheduled like the task itself
+def current_priority() -> float:
+    return _tls.context.priority
+
+# Within this, tasks created are given priority rather than the current one
+# (anything they go on to start inherits it as usual)
+class task_priority(_context_setting):
+    def __init__(self, priority: float) -> None:
+        self._changes = {'priority': priority}
+
+def current_exec_hook() -> _t.Optional[ExecHook]:
+    return _tls.context.exec_hook
+
+# Within this, tasks created (and anything they go on to start) report the
+# perf_counter() start and end and peak RSS of every SyncTask they run to hook
+class exec_hook(_context_setting):
+    def __init__(self, hook: ExecHook) -> None:
+        self._changes = {'exec_hook': hook}
+
+# Estimated peak RSS in bytes of the SyncTasks created now, the pool admits
+# jobs against its memory limits with it (see ThreadPool.set_limits)
+def current_job_memory() -> int:
+    return _tls.context.job_memory
+
+# Within this, tasks created (and anything they go on to start) give memory
+# as the estimate for every SyncTask they queue
+class job_memory(_context_setting):
+    def __init__(self, memory: int) -> None:
+        self._changes = {'job_memory': memory}
+
+# peak RSS of a process run by the current SyncTask, the task's peak RSS is
+# the largest reported
+def report_rss(rss: int) -> None:
+    task = _tls.sync_task
+    if task is not None:
+        task.peak_rss = max(task.peak_rss, rss)
+
+class Cancelled(Exception):
+    """Result of a task cancelled before it completed."""
+
+class CancelToken:
+    """Cancels every task created within cancel_scope(token), and anything
+    they go on to start. Queued SyncTasks are dropped without running,
+    generators are closed the next time they would be stepped and running
+    code can register on_cancel callbacks (eg. to kill a subprocess)."""
+    _lck: _thr.Lock
+    _callbacks: _t.Dict[int, _t.Callable[[], None]]
+    _next_id: int
+    cancelled: bool
+
+    def __init__(self) -> None:
+        self._lck = _thr.Lock()
+        self._callbacks = {}
+        self._next_id = 0
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        with self._lck:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = list(self._callbacks.values())
+            self._callbacks = {}
+        for fn in callbacks:
+            fn()
+
+    # calls fn once cancelled (immediately if it already is), returns a
+    # function that unregisters it
+    def on_cancel(self, fn: _t.Callable[[], None]) -> _t.Callable[[], None]:
+        with self._lck:
+            if not self.cancelled:
+                cb_id = self._next_id
+                self._next_id += 1
+                self._callbacks[cb_id] = fn
+                def remove() -> None:
+                    with self._lck:
+                        self._callbacks.pop(cb_id, None)
+                return remove
+        fn()
+        return lambda: None
+
+def current_cancel_token() -> _t.Optional[CancelToken]:
+    return _tls.context.cancel_token
+
+class cancel_scope(_context_setting):
+    def __init__(self, token: CancelToken) -> None:
+        self._changes = {'cancel_token': token}
+
 class AsyncTask(_t.Generic[T]):
     @classmethod
     def yf_all(cls, tasks: '_t.List[AsyncTask[T]]') -> _t.Generator[None, None, _t.List[T]]:
-        indicies = set(range(len(tasks)))
-        to_drop: _t.Set[int] = set()
-        ret: _t.List[_t.Optional[T]]=[None]*len(tasks)
-        while len(indicies):
-            for i in indicies:
-                if tasks[i].step():
-                    to_drop.add(i)
-                    ret[i] = tasks[i].value
-                else:
-                    yield
-            indicies -= to_drop
-            to_drop = set()
-        for r in ret:
-            assert r is not None
-        return ret # type: ignore
+        pending = [t for t in tasks if not t.done]
+        while len(pending):
+            _wait_for(pending)
+            yield
+            pending = [t for t in pending if not t.done]
+        return [t.value for t in tasks]
+
+    @classmethod
+    def pending(cls) -> 'AsyncTask[T]':
+        # task with no generator, completed externally through _finish (see SyncTask)
+        ret: AsyncTask[T] = cls.__new__(cls)
+        ret._lck = _thr.Lock()
+        ret._callbacks = []
+        ret._context = _tls.context
+        if ret._context.cancel_token is not None:
+            ret._context.cancel_token.on_cancel(ret.cancel)
+        return ret
 
     _lck: _thr.Lock
+    _callbacks: _t.List[_t.Callable[['AsyncTask[T]'], None]]
+    _context: _TaskContext
     _generator: _t.Optional[_t.Generator[None, None, T]]=None
     _value: _t.Optional[_t.Tuple[_t.Optional[T], _t.Optional[Exception]]]=None
 
     def __init__(self, res: _t.Union[T, _t.Generator[None, None, T]]) -> None:
         self._lck = _thr.Lock()
-        if _ins.isgenerator(res):
+        self._callbacks = []
+        self._context = _tls.context
+        if isinstance(res, _types.GeneratorType):
             self._generator = res
         else:
-            # value resolved with _ins.isgenerator above
+            # value resolved with the GeneratorType check above
             self._value = (res, None) # type: ignore
 
+    # the priority of the SyncTasks it starts
+    @property
+    def priority(self) -> float:
+        return self._context.priority
+
+    @priority.setter
+    def priority(self, priority: float) -> None:
+        self._context = self._context._replace(priority=priority)
+
     @property
     def done(self) -> bool:
         return self._value is not None # should be atomic, checkup on this with GIL rework
 
+    # what the task failed with, None if it hasn't completed or succeeded
+    @property
+    def exception(self) -> _t.Optional[Exception]:
+        return None if self._value is None else self._value[1]
+
     @property
     def value(self) -> T:
-        while not self.done:
-            self.step()
+        if not self.done:
+            _Loop().run(self)
         assert self._value is not None
         val, err = self._value
         if err is not None:
@@ -57,110 +202,519 @@ class AsyncTask(_t.Generic[T]):
     # intended for use with 'yield for' operation
     @property
     def yfvalue(self) -> _t.Generator[None, None, T]:
-        while not self.step():
+        while not self.done:
+            _wait_for([self])
             yield
         return self.value
 
+    # Calls fn(self) once the task completes, immediately if it already has
+    def add_done_callback(self, fn: _t.Callable[['AsyncTask[T]'], None]) -> None:
+        with self._lck:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
     # Returns true if this step completed the task or it was already complete
     # false othewise
     def step(self) -> bool:
         with self._lck:
-            if not self.done:
+            if self.done or self._generator is None:
+                return self.done
+            token = self._context.cancel_token
+            if token is not None and token.cancelled:
+                callbacks = self._cancel()
+            else:
+                prev = _tls.context
+                _tls.context = self._context
                 try:
-                    assert self._generator is not None
                     next(self._generator)
+                    return False
                 except StopIteration as stop:
-                    self._value = (stop.value, None)
+                    callbacks = self._set_value((stop.value, None))
                 except Exception as err:
-                    self._value = (None, err)
-            return self.done
+                    callbacks = self._set_value((None, err))
+                finally:
+                    _tls.context = prev
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    # Completes the task with Cancelled unless it already completed, a
+    # generator is closed (running its finally blocks) first
+    def cancel(self) -> None:
+        with self._lck:
+            if self.done:
+                return
+            callbacks = self._cancel()
+        for fn in callbacks:
+            fn(self)
+
+    # must hold _lck
+    def _cancel(self) -> _t.List[_t.Callable[['AsyncTask[T]'], None]]:
+        if self._generator is not None:
+            try:
+                self._generator.close()
+            except Exception:
+                pass
+        return self._set_value((None, Cancelled()))
+
+    # complete a task made with pending(), ignored if it was cancelled first
+    def set_result(self, value: T) -> None:
+        self._finish((value, None))
+
+    def set_exception(self, err: Exception) -> None:
+        self._finish((None, err))
+
+    def _finish(self, value: _t.Tuple[_t.Optional[T], _t.Optional[Exception]]) -> None:
+        with self._lck:
+            if self.done:
+                return
+            callbacks = self._set_value(value)
+        for fn in callbacks:
+            fn(self)
+
+    # must hold _lck, returns the callbacks to run once it is released
+    def _set_value(self, value: _t.Tuple[_t.Optional[T], _t.Optional[Exception]]) -> _t.List[_t.Callable[['AsyncTask[T]'], None]]:
+        assert self._value is None
+        self._value = value
+        callbacks = self._callbacks
+        self._callbacks = []
+        return callbacks
+
+class TaskQueue(_t.Generic[T]):
+    """Hands back the tasks added to it as they complete, for a generator
+    working through results in completion order while adding more (see
+    yf_next). Each task gets one completion callback when it is added,
+    however many times yf_next waits."""
+    _lck: _thr.Lock
+    _finished: _t.Deque[AsyncTask[T]]
+    # added since yf_next last waited, the loop starts them with that wait
+    _added: _t.List[AsyncTask[T]]
+    # completed when a task finishes while yf_next is waiting
+    _wake: _t.Optional[AsyncTask[None]]
+    # added and not handed back yet
+    remaining: int
+
+    def __init__(self, tasks: _t.Iterable[AsyncTask[T]]=()) -> None:
+        self._lck = _thr.Lock()
+        self._finished = _col.deque()
+        self._added = []
+        self._wake = None
+        self.remaining = 0
+        for task in tasks:
+            self.add(task)
+
+    def add(self, task: AsyncTask[T]) -> None:
+        with self._lck:
+            self.remaining += 1
+            self._added.append(task)
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, task: AsyncTask[T]) -> None:
+        with self._lck:
+            self._finished.append(task)
+            wake = self._wake
+            self._wake = None
+        if wake is not None:
+            wake.set_result(None)
+
+    # waits for at least one task to complete, returns every one that has
+    # since the last call (none once all have been handed back)
+    def yf_next(self) -> _t.Generator[None, None, _t.List[AsyncTask[T]]]:
+        while True:
+            with self._lck:
+                if len(self._finished) or not self.remaining:
+                    done = list(self._finished)
+                    self._finished.clear()
+                    self.remaining -= len(done)
+                    return done
+                wake: AsyncTask[None] = AsyncTask.pending()
+                self._wake = wake
+                added = self._added
+                self._added = []
+            _wait_for([wake, *added], 1)
+            yield
+
+class Tracer:
+    """Records complete ('X') events in Chrome trace event format, viewable in
+    chrome://tracing or https://ui.perfetto.dev"""
+    _lck: _thr.Lock
+    _start: float
+    _events: _t.List[_t.Dict[str, _t.Any]]
+    _threads: _t.Dict[int, str]
+
+    def __init__(self) -> None:
+        self._lck = _thr.Lock()
+        self._start = _time.perf_counter()
+        self._events = []
+        self._threads = {}
+
+    # start and end are perf_counter() times
+    def complete(self, name: str, cat: str, start: float, end: float, *, args: _t.Optional[_t.Dict[str, _t.Any]]=None) -> None:
+        tid = _thr.get_ident()
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': (start - self._start) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': 0,
+            'tid': tid,
+            'args': args or {},
+        }
+        with self._lck:
+            self._threads.setdefault(tid, _thr.current_thread().name)
+            self._events.append(event)
+
+    def write(self, path: str) -> None:
+        with self._lck:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': name}} for tid, name in self._threads.items()]
+            events = names + self._events
+        with open(path, 'w') as f:
+            _json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+_tracer: _t.Optional[Tracer] = None
+
+def set_tracer(tracer: _t.Optional[Tracer]) -> None:
+    global _tracer
+    _tracer = tracer
+
+def get_tracer() -> _t.Optional[Tracer]:
+    return _tracer
+
+# Generators yield None while blocked, the tasks they are blocked on are passed
+# out of band so the generator types stay Generator[None, None, T]. They don't
+# step the tasks they wait on themselves, the loop does (see _Loop)
+
+def _wait_for(tasks: _t.Sequence[AsyncTask[_t.Any]], count: _t.Optional[int]=None) -> None:
+    _tls.waiting = (tasks, len(tasks) if count is None else count)
+
+class _Loop:
+    """Drives AsyncTask generators, only stepping a task again once enough of
+    the tasks it is waiting on have completed. A generator task is started
+    the first time something waits on it, from then on it is only queued by
+    its own wake, so a task shared by many waiters is stepped once per wait
+    of its own rather than once per waiter."""
+    _cv: _thr.Condition
+    _ready: _t.Deque[AsyncTask[_t.Any]]
+    # generator tasks queued or blocked here, only touched by the thread running the loop
+    _driving: _t.Set[AsyncTask[_t.Any]]
+
+    def __init__(self) -> None:
+        self._cv = _thr.Condition()
+        self._ready = _col.deque()
+        self._driving = set()
+
+    def _schedule(self, task: AsyncTask[_t.Any]) -> None:
+        with self._cv:
+            self._ready.append(task)
+            self._cv.notify()
+
+    def _start(self, task: AsyncTask[_t.Any]) -> None:
+        self._driving.add(task)
+        self._schedule(task)
+
+    def _wake_after(self, task: AsyncTask[_t.Any], waiting: _t.Sequence[AsyncTask[_t.Any]], count: int) -> None:
+        remaining = [count]
+        lck = _thr.Lock()
+        def on_done(_: AsyncTask[_t.Any]) -> None:
+            with lck:
+                remaining[0] -= 1
+                if remaining[0] != 0:
+                    return
+            self._schedule(task)
+        for w in waiting:
+            # a task with a generator has to be stepped by someone, unless it
+            # already is it's left to its own wake
+            if w._generator is not None and not w.done and w not in self._driving:
+                self._start(w)
+            w.add_done_callback(on_done)
+
+    def run(self, root: AsyncTask[_t.Any]) -> None:
+        if root._generator is None:
+            self._wake_after(root, [root], 1)
+        else:
+            self._start(root)
+        start = _time.perf_counter()
+        idle = 0.0
+        steps = 0
+        while not root.done:
+            with self._cv:
+                if not len(self._ready):
+                    idle_start = _time.perf_counter()
+                    while not len(self._ready):
+                        self._cv.wait()
+                    idle += _time.perf_counter() - idle_start
+                task = self._ready.popleft()
+            steps += 1
+            _tls.waiting = None
+            if task.step():
+                self._driving.discard(task)
+                continue
+            waiting: _t.Optional[_t.Tuple[_t.Sequence[AsyncTask[_t.Any]], int]] = _tls.waiting
+            _tls.waiting = None
+            if waiting is None:
+                # plain yield, nothing to wait on so poll again
+                self._schedule(task)
+            else:
+                self._wake_after(task, *waiting)
+        if _tracer is not None:
+            end = _time.perf_counter()
+            _tracer.complete('loop', 'loop', start, end, args={'steps': steps, 'stepping_ms': (end - start - idle) * 1000, 'waiting_ms': idle * 1000})
+
+# MemAvailable from /proc/meminfo in bytes, None where there isn't one
+def available_memory() -> _t.Optional[int]:
+    try:
+        with open('/proc/meminfo', 'rb') as f:
+            for line in f:
+                if line.startswith(b'MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+# how often a pool held back by load or available memory looks again
+_throttle_poll = 0.1
 
 class ThreadPool:
+    """Runs queued SyncTasks on up to nthreads worker threads, highest
+    priority first then in queued order (or just in queued order without
+    priorities). With limits set (see set_limits) the next task waits while
+    it would go over them, unless nothing else is running. Workers are
+    started as tasks are queued and stop at shutdown(), or on leaving a with
+    block on the pool, once the queue is empty."""
     _cv: _thr.Condition
     _nthreads: int
-    _pending: _t.List['SyncTask[_t.Any]']
-    _workers: int
-    _active: int
+    _priorities: bool
+    # queued tasks by priority with a heap of the (negated) priorities that
+    # have any. Tasks mostly share a priority with others, so queueing and
+    # taking one is usually a deque append and popleft
+    _levels: _t.Dict[float, _t.Deque['SyncTask[_t.Any]']]
+    _level_heap: _t.List[float]
+    _npending: int
+    _threads: _t.List[_thr.Thread]
+    # workers waiting for a task, those woken for a queued task that have
+    # yet to take it, and the waiting workers held back by the limits
+    _idle: int
+    _waking: int
+    _throttled: int
+    # tasks running and the sum of their memory estimates
+    _running: int
+    _running_memory: int
+    _shutdown: bool
+    max_memory: _t.Optional[int]
+    min_available: _t.Optional[int]
+    max_load: _t.Optional[float]
 
-    def __init__(self, nthreads: _t.Optional[int]=None) -> None:
+    def __init__(self, nthreads: _t.Optional[int]=None, *, priorities: bool=True) -> None:
         self._cv = _thr.Condition()
         if nthreads is None:
-            self._nthreads = _mp.cpu_count()
+            self._nthreads = _os.cpu_count() or 1
         else:
             assert nthreads > 0
             self._nthreads = nthreads
-        self._pending = []
-        self._workers = 0
-        self._active = 0
+        self._priorities = priorities
+        self._levels = {}
+        self._level_heap = []
+        self._npending = 0
+        self._threads = []
+        self._idle = 0
+        self._waking = 0
+        self._throttled = 0
+        self._running = 0
+        self._running_memory = 0
+        self._shutdown = False
+        self.max_memory = None
+        self.min_available = None
+        self.max_load = None
 
-    def queue(self, task: 'SyncTask[_t.Any]') -> None:
+    def __enter__(self) -> 'ThreadPool':
+        return self
+
+    def __exit__(self, *args: _t.Any) -> None:
+        self.shutdown()
+
+    # max_memory bounds the estimated memory of the tasks running at once,
+    # min_available the memory left free once the next one is running
+    # (both in bytes), max_load the 1 minute load average new tasks start at
+    def set_limits(self, *, max_memory: _t.Optional[int]=None, min_available: _t.Optional[int]=None, max_load: _t.Optional[float]=None) -> None:
         with self._cv:
-            self._pending.append(task)
-            if self._active + len(self._pending) > self._workers and self._workers < self._nthreads:
+            self.max_memory = max_memory
+            self.min_available = min_available
+            self.max_load = max_load
+            self._cv.notify_all()
+
+    # must hold _cv. Returns 0 if task can start now, otherwise how long to
+    # wait before looking again (None for until a task finishes)
+    def _admit_wait(self, task: 'SyncTask[_t.Any]') -> _t.Optional[float]:
+        if self._running == 0:
+            # always make progress, however big the task
+            return 0
+        if self.max_memory is not None and self._running_memory + task.memory > self.max_memory:
+            return None
+        if self.min_available is not None:
+            available = available_memory()
+            if available is not None and available - task.memory < self.min_available:
+                return _throttle_poll
+        if self.max_load is not None:
+            try:
+                if _os.getloadavg()[0] > self.max_load:
+                    return _throttle_poll
+            except OSError:
+                pass
+        return 0
+
+    # extra workers stop once they are idle
+    def set_nthreads(self, nthreads: int) -> None:
+        assert nthreads > 0
+        with self._cv:
+            self._nthreads = nthreads
+            for _ in range(min(self._nthreads - len(self._threads), self._npending)):
                 self._start_worker()
-            self._cv.notify()
+            self._cv.notify_all()
 
-    def _start_worker(self) -> None:
-        self._workers += 1
-        self._active += 1
-        _thr.Thread(target=self._worker, args=[_wr.ref(self)], daemon=True).start()
+    def queue(self, task: 'SyncTask[_t.Any]') -> None:
+        priority = -task.priority if self._priorities else 0.0
+        with self._cv:
+            if self._shutdown:
+                raise RuntimeError('ThreadPool is shut down')
+            level = self._levels.get(priority)
+            if level is None:
+                level = self._levels[priority] = _col.deque()
+                _hq.heappush(self._level_heap, priority)
+            level.append(task)
+            self._npending += 1
+            # each idle worker is only woken for one task
+            if self._idle > self._waking:
+                self._waking += 1
+                self._cv.notify()
+            elif len(self._threads) < self._nthreads:
+                self._start_worker()
 
-    def __del__(self) -> None:
+    # Stops the workers once every queued task has run, or drops the queued
+    # tasks (completing them as Cancelled) with cancel_pending
+    def shutdown(self, *, wait: bool=True, cancel_pending: bool=False) -> None:
         with self._cv:
-            self._workers = 0
+            self._shutdown = True
+            dropped: _t.List['SyncTask[_t.Any]'] = []
+            if cancel_pending:
+                for level in self._levels.values():
+                    dropped.extend(level)
+                self._levels = {}
+                self._level_heap = []
+                self._npending = 0
+            threads = list(self._threads)
             self._cv.notify_all()
+        for task in dropped:
+            task._drop()
+        if wait:
+            for thread in threads:
+                if thread is not _thr.current_thread():
+                    thread.join()
 
-    @classmethod
-    def _worker(cls, pool: '_wr.ref[ThreadPool]') -> None:
-        _self: _t.Optional['ThreadPool']=pool()
-        while _self is not None and _self._workers > 0:
-            cv = _self._cv
-            with cv:
-                _self._active -= 1
-                while len(_self._pending) == 0:
-                    del _self
-                    cv.wait()
-                    _self = pool()
-                    if _self is None or _self._workers == 0:
-                        return
+    # must hold _cv
+    def _start_worker(self) -> None:
+        thread = _thr.Thread(target=self._worker, daemon=True)
+        self._threads.append(thread)
+        thread.start()
 
-                task = _self._pending[0]
-                _self._active += 1
-                _self._pending = _self._pending[1:]
-                if len(_self._pending) > 0:
-                    _self._cv.notify()
+    # must hold _cv and have tasks pending
+    def _peek(self) -> 'SyncTask[_t.Any]':
+        return self._levels[self._level_heap[0]][0]
+
+    # must hold _cv and have tasks pending
+    def _pop(self) -> 'SyncTask[_t.Any]':
+        priority = self._level_heap[0]
+        level = self._levels[priority]
+        task = level.popleft()
+        if not len(level):
+            del self._levels[priority]
+            _hq.heappop(self._level_heap)
+        self._npending -= 1
+        return task
+
+    def _worker(self) -> None:
+        task: _t.Optional['SyncTask[_t.Any]'] = None
+        while True:
+            with self._cv:
+                if task is not None:
+                    self._running -= 1
+                    self._running_memory -= task.memory
+                    # the next task may fit now
+                    if self._throttled > 0:
+                        self._cv.notify()
+                while True:
+                    if (self._shutdown and self._npending == 0) or len(self._threads) > self._nthreads:
+                        self._threads.remove(_thr.current_thread())
+                        return
+                    timeout: _t.Optional[float] = None
+                    if self._npending > 0:
+                        timeout = self._admit_wait(self._peek())
+                        if timeout == 0:
+                            break
+                    throttled = self._npending > 0
+                    self._idle += 1
+                    self._throttled += throttled
+                    self._cv.wait(timeout)
+                    self._idle -= 1
+                    self._waking = max(0, self._waking - 1)
+                    self._throttled -= throttled
+                task = self._pop()
+                self._running += 1
+                self._running_memory += task.memory
             # use try_exec for early escape if someone else is already executing this
             task.try_exec()
 
 _system_thread_pool = ThreadPool()
 
+# limit on SyncTasks run at once by the default pool
+def set_jobs(njobs: int) -> None:
+    _system_thread_pool.set_nthreads(njobs)
+
+# limits on starting SyncTasks in the default pool, see ThreadPool.set_limits
+def set_job_limits(*, max_memory: _t.Optional[int]=None, min_available: _t.Optional[int]=None, max_load: _t.Optional[float]=None) -> None:
+    _system_thread_pool.set_limits(max_memory=max_memory, min_available=min_available, max_load=max_load)
+
+# guards making SyncTask._done
+_done_lck = _thr.Lock()
+
 class SyncTask(_t.Generic[T]):
     _lck: _thr.Lock
     _fn: _t.Callable[[], T]
     as_async: AsyncTask[T]
-    _wait_delay: float
-    _last_check: _t.Optional[float]=None
+    priority: float
+    name: str
+    _queued_at: float
+    # fn runs with it, see AsyncTask
+    _context: _TaskContext
+    # estimated and measured (see report_rss) peak RSS in bytes
+    memory: int
+    peak_rss: int
+    # set once the task completes however that happened, only made when
+    # something waits (see wait)
+    _done: _t.Optional[_thr.Event]=None
     _value: _t.Optional[_t.Tuple[_t.Optional[T], _t.Optional[Exception]]]=None
 
-    def __init__(self, fn: _t.Callable[[], T], *, pool: _t.Optional[ThreadPool]=None, wait_delay: float=0.001) -> None:
+    def __init__(self, fn: _t.Callable[[], T], *, pool: _t.Optional[ThreadPool]=None, priority: _t.Optional[float]=None, name: _t.Optional[str]=None) -> None:
         self._lck = _thr.Lock()
         self._fn = fn # type: ignore
-        self.as_async = AsyncTask(self._async_value())
-        self._wait_delay = wait_delay
+        self.priority = current_priority() if priority is None else priority
+        # for traces
+        self.name = fn.__qualname__ if name is None else name
+        self._queued_at = _time.perf_counter()
+        self._context = _tls.context
+        self.memory = self._context.job_memory
+        self.peak_rss = 0
+        # completed by whichever thread ends up running fn, waking anything waiting on it
+        self.as_async = AsyncTask.pending()
+        if self._context.cancel_token is not None:
+            self._context.cancel_token.on_cancel(self._drop)
         if pool is None:
             _system_thread_pool.queue(self)
         else:
             pool.queue(self)
 
-    def _async_value(self) -> _t.Generator[None, None, T]:
-        while not self.done:
-            if self._last_check is not None:
-                if _time.time() - self._last_check < self._wait_delay:
-                    _time.sleep(self._wait_delay)
-            self._last_check = _time.time()
-            yield
-        return self.value
-
     @property
     def done(self) -> bool:
         return self._value is not None
@@ -172,11 +726,8 @@ class SyncTask(_t.Generic[T]):
     def try_exec(self) -> bool:
         if self._lck.acquire(blocking=False):
             try:
-                if self._value is not None:
-                    return True
-                self._value = (self._fn(), None) # type: ignore
-            except Exception as err:
-                self._value = (None, err)
+                if self._value is None:
+                    self._call()
             finally:
                 self._lck.release()
             return True
@@ -184,13 +735,71 @@ class SyncTask(_t.Generic[T]):
 
     def exec(self) -> None:
         with self._lck:
-            if self._value is not None:
-                return
+            if self._value is None:
+                self._call()
 
+    # cancelled, completes the task unless fn is already running, the pool
+    # skips it when it comes up
+    def _drop(self) -> None:
+        if self._lck.acquire(blocking=False):
             try:
-                self._value = (self._fn(), None) # type: ignore
-            except Exception as err:
-                self._value = (None, err)
+                if self._value is None:
+                    self._value = (None, Cancelled())
+                    self._set_done()
+                    self.as_async._finish(self._value)
+            finally:
+                self._lck.release()
+
+    def _call(self) -> None:
+        start = _time.perf_counter()
+        prev_context = _tls.context
+        prev_task = _tls.sync_task
+        _tls.context = self._context
+        _tls.sync_task = self
+        try:
+            token = self._context.cancel_token
+            if token is not None and token.cancelled:
+                raise Cancelled()
+            self._value = (self._fn(), None) # type: ignore
+        except Exception as err:
+            self._value = (None, err)
+        finally:
+            _tls.context = prev_context
+            _tls.sync_task = prev_task
+        end = _time.perf_counter()
+        hook = self._context.exec_hook
+        if hook is not None:
+            hook(start, end, self.peak_rss)
+        if _tracer is not None:
+            _tracer.complete(self.name, 'task', start, end, args={
+                'queue_wait_ms': (start - self._queued_at) * 1000,
+                'priority': self.priority,
+                'memory_mb': self.memory / (1 << 20),
+                'peak_rss_mb': self.peak_rss / (1 << 20),
+                'failed': self._value[1] is not None,
+            })
+        self._set_done()
+        self.as_async._finish(self._value)
+
+    # after _value is set
+    def _set_done(self) -> None:
+        done = self._done
+        if done is not None:
+            done.set()
+
+    # blocks until the task completes without running it here (unlike run),
+    # returns false on timeout
+    def wait(self, timeout: _t.Optional[float]=None) -> bool:
+        if self._value is not None:
+            return True
+        with _done_lck:
+            if self._done is None:
+                self._done = _thr.Event()
+            done = self._done
+        # completed before the event was there to be set
+        if self._value is not None:
+            return True
+        return done.wait(timeout)
 
     def run(self) -> T:
         if self._value is None: